@@ -1,16 +1,24 @@
 import base64
+import copy
+import random
 import re
+import threading
+import time
 from io import BytesIO
 
 import boto3
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import botocore
 import tifffile
 import s3fs
 import zarr
 
+from .util.cache import ResponseCache
+from .util.ratelimit import RateLimitedStore
+
 
 class InvalidUsernameOrPassword(Exception):
     pass
@@ -19,22 +27,63 @@ class InvalidUsernameOrPassword(Exception):
 class InvalidCognitoClientId(Exception):
     pass
 
+
+class TokenRefreshFailed(Exception):
+    pass
+
+# Methods which can be safely retried, because repeating the request has no additional effect
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+# Transient errors, 429 means the request was not processed, so it is retried for all methods
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
 class MinervaClient:
-    def __init__(self, endpoint, region, cognito_client_id):
+    def __init__(self, endpoint, region, cognito_client_id, pool_maxsize=10, max_retries=5,
+                 backoff_factor=0.5, backoff_max=30, cache_ttl=0, cache_dir=None, cache_revalidate=False,
+                 refresh_margin=300, timeout=(10, 60)):
+        """
+        Parameters
+        ----------
+        endpoint - Minerva API base url
+        region - AWS region
+        cognito_client_id - Cognito app client id
+        pool_maxsize - Maximum number of pooled HTTP connections, should be at least the number of worker threads
+        max_retries - How many times a failed request is retried
+        backoff_factor - Base delay in seconds for exponential backoff between retries
+        backoff_max - Maximum delay in seconds between retries
+        cache_ttl - Seconds for which image, dimension and metadata responses are cached, 0 (default) disables
+            caching. Cached responses may be stale for this long if the image is changed by someone else.
+        cache_dir - Directory for an on-disk response cache shared between runs, disabled if None
+        cache_revalidate - Revalidate expired cache entries with If-None-Match instead of re-downloading
+        refresh_margin - Seconds before id token expiry when the token is renewed with the refresh token
+        timeout - Seconds to wait for a connection and for response data, as (connect, read) or one value for both.
+            Requests which time out are retried like connection errors. None waits forever.
+        """
         self.endpoint = endpoint
         self.region = region
         self.cognito_client_id = cognito_client_id
         self.id_token = None
         self.token_type = None
         self.refresh_token = None
+        self.token_expires = None
+        self.refresh_margin = refresh_margin
+        self.auth_headers = {}
+        self._token_lock = threading.Lock()
+        self._cognito = None
         self.session = None
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self._session_lock = threading.Lock()
         self.credentials_cache = {}
+        self.response_cache = ResponseCache(cache_ttl, cache_dir, cache_revalidate) if cache_ttl > 0 else None
 
     def authenticate(self, username, password):
         try:
             logging.info("Logging in as %s", username)
-            config = botocore.config.Config(signature_version=botocore.UNSIGNED, region_name=self.region)
-            client = boto3.client('cognito-idp', config=config)
+            client = self._get_cognito_client()
             response = client.initiate_auth(
                 AuthFlow='USER_PASSWORD_AUTH',
                 AuthParameters={
@@ -43,9 +92,7 @@ class MinervaClient:
                 },
                 ClientId=self.cognito_client_id
             )
-            self.id_token = response["AuthenticationResult"]["IdToken"]
-            self.token_type = response["AuthenticationResult"]["TokenType"]
-            self.refresh_token = response["AuthenticationResult"]["RefreshToken"]
+            self._set_tokens(response["AuthenticationResult"])
             logging.debug("Authenticated successfully")
         except client.exceptions.NotAuthorizedException:
             raise InvalidUsernameOrPassword
@@ -53,31 +100,172 @@ class MinervaClient:
             logging.error(e)
             raise InvalidCognitoClientId
 
-    def request(self, method, path, body=None, parameters=None, json_response=True):
+    def refresh(self, expired_token=None):
+        """
+        Renews the id token using the refresh token (REFRESH_TOKEN_AUTH).
+        Safe to call from several threads, only one of them contacts Cognito.
+
+        Parameters
+        ----------
+        expired_token - Id token which was rejected, the refresh is skipped if another thread already replaced it.
+            If None, the token is always renewed.
+        """
+        self._refresh(expired_token)
+
+    def _refresh(self, expired_token=None, only_if_expiring=False):
+        """
+        Parameters
+        ----------
+        only_if_expiring - Skip the refresh unless the token is about to expire, for the check ahead of expiry
+            made before requests. Another thread may have renewed the token while this one waited for the lock.
+        """
+        if self.refresh_token is None:
+            raise TokenRefreshFailed("No refresh token, authenticate first")
+
+        with self._token_lock:
+            if expired_token is not None and expired_token != self.id_token:
+                return
+            if only_if_expiring and not self._token_expiring():
+                return
+
+            logging.info("Refreshing id token")
+            client = self._get_cognito_client()
+            try:
+                response = client.initiate_auth(
+                    AuthFlow='REFRESH_TOKEN_AUTH',
+                    AuthParameters={
+                        'REFRESH_TOKEN': self.refresh_token
+                    },
+                    ClientId=self.cognito_client_id
+                )
+            except client.exceptions.NotAuthorizedException as e:
+                logging.error(e)
+                raise TokenRefreshFailed(str(e))
+            self._set_tokens(response["AuthenticationResult"])
+
+    def _get_cognito_client(self):
+        if self._cognito is None:
+            config = botocore.config.Config(signature_version=botocore.UNSIGNED, region_name=self.region)
+            self._cognito = boto3.client('cognito-idp', config=config)
+        return self._cognito
+
+    def _token_expiring(self):
+        return self.token_expires is not None and time.time() > self.token_expires - self.refresh_margin
+
+    def _set_tokens(self, result):
+        # Build the header once per token, instead of rewriting session headers on every request.
+        # The header is replaced before id_token, so a request never pairs a new id_token with an old header.
+        self.auth_headers = {"Authorization": result["TokenType"] + " " + result["IdToken"]}
+        self.token_type = result["TokenType"]
+        self.id_token = result["IdToken"]
+        self.refresh_token = result.get("RefreshToken", self.refresh_token)
+        if "ExpiresIn" in result:
+            self.token_expires = time.time() + result["ExpiresIn"]
+
+    def _get_session(self):
         if self.session is None:
-            self.session = requests.Session()
-
-        self.session.headers.update({
-            "Authorization": self.token_type + " " + self.id_token,
-            "Content-Type": "application/json"
-        })
+            with self._session_lock:
+                if self.session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update({"Content-Type": "application/json"})
+                    self.session = session
+        return self.session
+
+    def _backoff_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** attempt))
+
+    def _send(self, method, path, body=None, parameters=None, headers=None):
+        session = self._get_session()
         url = self.endpoint + path
 
         if body is not None:
             body = json.dumps(body)
 
-        response = self.session.request(method=method, url=url, data=body, params=parameters)
+        if self.refresh_token is not None and self._token_expiring():
+            self._refresh(only_if_expiring=True)
+
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        refreshed = False
+        while True:
+            response = None
+            id_token = self.id_token
+            request_headers = dict(self.auth_headers, **headers) if headers else self.auth_headers
+            try:
+                response = session.request(method=method, url=url, data=body, params=parameters,
+                                           headers=request_headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                logging.warning("%s %s failed (%s), retrying", method, path, e)
+            else:
+                if response.status_code == 401 and self.refresh_token is not None and not refreshed:
+                    # Token expired or was revoked, renew it and repeat the request once
+                    logging.warning("%s %s returned 401, refreshing token", method, path)
+                    self.refresh(expired_token=id_token)
+                    refreshed = True
+                    continue
+
+                retryable = response.status_code in RETRY_STATUS_CODES and \
+                    (idempotent or response.status_code == 429)
+                if not retryable or attempt >= self.max_retries:
+                    break
+                logging.warning("%s %s returned %s, retrying", method, path, response.status_code)
+
+            time.sleep(self._backoff_delay(attempt, response))
+            attempt += 1
 
         if response.status_code >= 400:
             logging.error(response.text)
 
         response.raise_for_status()
         logging.debug(response)
+        return response
+
+    def request(self, method, path, body=None, parameters=None, json_response=True):
+        response = self._send(method, path, body, parameters)
         if json_response:
             return response.json()
         else:
             return response.text
 
+    def cached_request(self, path, json_response=True):
+        """
+        GET request for read-only resources, served from the response cache while fresh.
+        Returns a copy, so callers can modify the response without changing the cache.
+        """
+        if self.response_cache is None:
+            return self.request('GET', path, json_response=json_response)
+
+        # Clients of different deployments can share a cache directory, so entries are keyed by the full url
+        key = self.endpoint + path
+        entry = self.response_cache.get(key)
+        if entry is not None and self.response_cache.is_fresh(entry):
+            return copy.deepcopy(entry.value)
+
+        headers = None
+        if entry is not None and entry.etag is not None and self.response_cache.revalidate:
+            headers = {"If-None-Match": entry.etag}
+
+        response = self._send('GET', path, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            logging.debug("Not modified: %s", path)
+            self.response_cache.touch(key)
+            return copy.deepcopy(entry.value)
+
+        value = response.json() if json_response else response.text
+        self.response_cache.put(key, value, response.headers.get("ETag"))
+        return copy.deepcopy(value)
+
     def list_repositories(self):
         return self.request('GET', '/repository')
 
@@ -112,30 +300,38 @@ class MinervaClient:
         }
         return credentials, bucket, prefix
 
-    def get_raw_tile(self, uuid, x, y, z, t, c, level, tile_size=1024):
+    def get_image_array(self, uuid, level=0):
+        """
+        Opens a pyramid level of a zarr image as a zarr Array with shape (T, C, Z, Y, X).
+        The filesystem is cached per image, so repeated calls reuse the same S3 connections.
+        """
         if uuid not in self.credentials_cache:
             self.get_image_credentials(uuid)
 
-        credentials = self.credentials_cache[uuid]["credentials"]
-        bucket = self.credentials_cache[uuid]["bucket"]
+        cached = self.credentials_cache[uuid]
+        if "group" not in cached:
+            credentials = cached["credentials"]
+            s3 = s3fs.S3FileSystem(anon=False,
+                                   client_kwargs=dict(region_name=self.region),
+                                   key=credentials["AccessKeyId"],
+                                   secret=credentials["SecretAccessKey"],
+                                   token=credentials["SessionToken"])
 
-        s3 = s3fs.S3FileSystem(anon=False,
-                               client_kwargs=dict(region_name=self.region),
-                               key=credentials["AccessKeyId"],
-                               secret=credentials["SecretAccessKey"],
-                               token=credentials["SessionToken"])
+            zarr_store = s3fs.S3Map(root=f"{cached['bucket']}/{uuid}", s3=s3, check=False, create=False)
+            # Chunk reads count against the process-wide download bandwidth limit
+            cached["group"] = zarr.group(store=RateLimitedStore(zarr_store), overwrite=False)
+        return cached["group"][str(level)]
 
-        zarr_store = s3fs.S3Map(root=f"{bucket}/{uuid}", s3=s3, check=False, create=False)
-        group = zarr.group(store=zarr_store, overwrite=False)
-        arr = group[str(level)]
+    def get_raw_tile(self, uuid, x, y, z, t, c, level, tile_size=1024):
+        arr = self.get_image_array(uuid, level)
         tile = arr[t, c, z, y:y + tile_size, x:x + tile_size]
         return tile
 
     def get_image_metadata(self, image_uuid):
-        return base64.b64decode(self.request('GET', '/image/' + image_uuid + '/metadata', json_response=False))
+        return base64.b64decode(self.cached_request('/image/' + image_uuid + '/metadata', json_response=False))
 
     def get_image(self, image_uuid):
-        return self.request('GET', '/image/' + image_uuid)
+        return self.cached_request('/image/' + image_uuid)
 
     def mark_import_complete(self, import_uuid):
         body = {
@@ -153,7 +349,7 @@ class MinervaClient:
         return self.request('GET', '/repository/' + repository_uuid + '/images')
 
     def get_image_dimensions(self, image_uuid):
-        return self.request('GET', '/image/' + image_uuid + '/dimensions')
+        return self.cached_request('/image/' + image_uuid + '/dimensions')
 
     def list_incomplete_imports(self):
         return self.request('GET', '/import/incomplete')
@@ -1,95 +1,397 @@
 from .client import MinervaClient
+from .util.manifest import TransferManifest
+from .util.s3 import S3ClientPool, S3Destination
+from .util.fileutils import FileUtils
+from .util.integrity import TransferReport, ChecksumMismatch, check_algorithm, verify_object
+from .util.concurrency import AdaptiveConcurrency
+from .util import ratelimit
 import logging
 import math
 import itertools
 import tifffile
+import imagecodecs
 import numpy as np
-import boto3
+import collections
+import concurrent.futures
+import functools
 import os
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from time import time
 from requests.exceptions import HTTPError
 
-SOFTWARE_TAG_CODE = 305
+SOFTWARE = "Minerva (Glencoe/Faas pyramid output)"
+
+# Compression schemes which can be encoded in the download pool ahead of the writer
+TILE_ENCODERS = {
+    "zlib": "zlib_encode",
+    "zstd": "zstd_encode",
+    "lzw": "lzw_encode",
+    "jpegxr": "jpegxr_encode"
+}
 
 logger = logging.getLogger("minerva")
 
+MANIFEST_FILENAME = ".minerva_manifest.jsonl"
+
+def scale_region(region, full_shape, level_shape):
+    """
+    Converts a region (x, y, width, height) in full resolution pixels into pixel bounds
+    (y0, x0, y1, x1) of a pyramid level, rounding outwards so the whole region is covered.
+    """
+    full_height, full_width = full_shape
+    height, width = level_shape
+    if region is None:
+        return 0, 0, height, width
+
+    x, y, region_width, region_height = region
+    scale_y = full_height / height
+    scale_x = full_width / width
+    y0 = max(0, math.floor(y / scale_y))
+    x0 = max(0, math.floor(x / scale_x))
+    y1 = min(height, math.ceil((y + region_height) / scale_y))
+    x1 = min(width, math.ceil((x + region_width) / scale_x))
+    if y1 <= y0 or x1 <= x0:
+        raise ValueError("Region {} is outside of the image".format(region))
+    return y0, x0, y1, x1
+
+
+def downscale_bounds(bounds, shape, level_shape):
+    """
+    Converts pixel bounds (y0, x0, y1, x1) of a pyramid level into bounds of a lower resolution level.
+    The size is divided and rounded up like the level shape itself, so the exported levels of a region
+    form a pyramid as well, e.g. a 250 pixel wide region is 125 and then 63 pixels wide.
+    """
+    factor_y = max(1, round(shape[0] / level_shape[0]))
+    factor_x = max(1, round(shape[1] / level_shape[1]))
+    y0, x0, y1, x1 = bounds
+    level_y0 = y0 // factor_y
+    level_x0 = x0 // factor_x
+    return (level_y0, level_x0, min(level_shape[0], level_y0 + math.ceil((y1 - y0) / factor_y)),
+            min(level_shape[1], level_x0 + math.ceil((x1 - x0) / factor_x)))
+
+class LevelPlan:
+    """
+    Tile grid of one pyramid level to export, based on the real shape of the stored array.
+    """
+
+    def __init__(self, level, array, channels, tile_shape, bounds=None):
+        """
+        Parameters
+        ----------
+        bounds - Pixel bounds (y0, x0, y1, x1) of the exported region in this level, whole level if None
+        """
+        self.level = level
+        self.array = array
+        self.channels = channels
+        self.tile_shape = tile_shape
+        self.bounds = bounds if bounds is not None else (0, 0, array.shape[3], array.shape[4])
+        self.height = self.bounds[2] - self.bounds[0]
+        self.width = self.bounds[3] - self.bounds[1]
+
+    @property
+    def shape(self):
+        return len(self.channels), self.height, self.width
+
+    @property
+    def num_tiles(self):
+        tile_height, tile_width = self.tile_shape
+        return len(self.channels) * math.ceil(self.height / tile_height) * math.ceil(self.width / tile_width)
+
+    def positions(self):
+        """
+        Tile positions (channel, y, x) in the level's pixel coordinates, in the order the TIFF writer expects them.
+        """
+        tile_height, tile_width = self.tile_shape
+        y0, x0, y1, x1 = self.bounds
+        return itertools.product(self.channels, range(y0, y1, tile_height), range(x0, x1, tile_width))
+
 class MinervaExporter:
-    def __init__(self, region):
+    def __init__(self, region, max_workers=None, client_pool=None, verify=None, attempts=3, concurrency=None):
+        """
+        Parameters
+        ----------
+        region - AWS region
+        max_workers - Fixed number of concurrent downloads, by default concurrency is tuned adaptively
+        client_pool - S3ClientPool to share S3 clients with other components, created if None
+        verify - Checksum algorithm (md5 or crc32c) for verifying downloaded objects, disabled if None
+        attempts - How many times an object is downloaded before it is reported as failed
+        concurrency - AdaptiveConcurrency which limits concurrent downloads, can be shared with an importer
+        """
+        if verify is not None:
+            check_algorithm(verify)
+        self.verify = verify
+        self.attempts = attempts
+        # Summary of the most recent export
+        self.report = TransferReport()
         self.region = region
+        if concurrency is None:
+            concurrency = AdaptiveConcurrency.fixed(max_workers) if max_workers is not None else AdaptiveConcurrency()
+        self.concurrency = concurrency
+        # Threads for the highest concurrency, the controller decides how many of them transfer at once
+        self.max_workers = concurrency.maximum
+        self.client_pool = client_pool if client_pool is not None else S3ClientPool(region, self.max_workers)
+        # Long-lived pool shared by all exports, so downloads never wait for a pool to start up.
+        # Stopped by close() or at the end of a with block.
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def close(self):
+        """
+        Waits for running downloads and stops the worker threads. The exporter cannot be used afterwards.
+        """
+        self.executor.shutdown(wait=True)
 
-    def export_image(self, minerva_client: MinervaClient, image_uuid: str, output_path: str, save_pyramid=False, progress_callback=lambda a,b : None, format="zarr"):
+    shutdown = close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def export_image(self, minerva_client: MinervaClient, image_uuid: str, output_path: str, save_pyramid=False, progress_callback=lambda a,b : None, format="zarr", region=None, channels=None, levels=None):
+        """
+        Parameters
+        ----------
+        region - Export only a region (x, y, width, height) given in full resolution pixels
+        channels - Export only these channel indices
+        levels - Export only these pyramid levels, overrides save_pyramid
+        """
         image, ome_metadata = self._get_image_and_metadata(minerva_client, image_uuid)
         if image is None:
             raise KeyError(image_uuid)
         logger.debug(ome_metadata)
 
         if format == "zarr":
-            return self.export_image_zarr(image, ome_metadata, minerva_client, image_uuid, output_path, save_pyramid, progress_callback)
+            return self.export_image_zarr(image, ome_metadata, minerva_client, image_uuid, output_path, save_pyramid, progress_callback, region=region, channels=channels, levels=levels)
         else:
-            return self.export_image_ometiff(image, ome_metadata, minerva_client, image_uuid, output_path, save_pyramid, progress_callback)
+            return self.export_image_ometiff(image, ome_metadata, minerva_client, image_uuid, output_path, save_pyramid, progress_callback, region=region, channels=channels, levels=levels)
+
+    def export_image_zarr(self, image, ome_metadata, minerva_client: MinervaClient, image_uuid: str, output_path: str, save_pyramid=False, progress_callback=lambda a,b : None, resume=True, region=None, channels=None, levels=None):
+        """
+        Downloads all objects of a zarr image. Downloads start while the bucket is still being listed.
+        Completed objects are recorded in a manifest file in output_path, so that an interrupted
+        export can be continued by calling this again; objects whose size and ETag match the
+        manifest are skipped.
+        If region, channels or levels are given, only the chunks covering the selection and the
+        zarr metadata are listed and downloaded, the rest of the arrays is left empty.
 
-    def export_image_zarr(self, image, ome_metadata, minerva_client: MinervaClient, image_uuid: str, output_path: str, save_pyramid=False, progress_callback=lambda a,b : None):
+        Parameters
+        ----------
+        resume - Skip objects which are already recorded in the manifest, if False everything is downloaded again
+        region - Export only chunks of this region (x, y, width, height) given in full resolution pixels
+        channels - Export only chunks of these channel indices
+        levels - Export only these pyramid levels
+        """
         credentials, bucket, prefix = minerva_client.get_image_credentials(image_uuid)
-        s3 = boto3.client("s3", aws_access_key_id=credentials["AccessKeyId"],
-                          aws_secret_access_key=credentials["SecretAccessKey"],
-                          aws_session_token=credentials["SessionToken"],
-                          region_name=self.region)
-
-        objs = []
-        more_objects = True
-        continuation_token = None
-        while more_objects:
-            args = {
-                "Bucket": bucket,
-                "Prefix": image_uuid,
-                "MaxKeys": 10000,
-            }
-            if continuation_token is not None:
-                args["ContinuationToken"] = continuation_token
-
-            result = s3.list_objects_v2(**args)
-            objs.extend(result["Contents"])
-            if not result["IsTruncated"]:
-                more_objects = False
-            else:
-                continuation_token = result["NextContinuationToken"]
+        s3 = self.client_pool.get(credentials)
+        self.report = TransferReport()
+
+        os.makedirs(output_path, exist_ok=True)
+        manifest_path = os.path.join(output_path, MANIFEST_FILENAME)
+        if not resume and os.path.exists(manifest_path):
+            os.remove(manifest_path)
 
-        total_files = len(objs)
+        total_files = 0
         files_processed = 0
+        lock = threading.Lock()
         def done_callback(f):
             nonlocal files_processed
-            nonlocal total_files
-            files_processed += 1
+            with lock:
+                files_processed += 1
+            progress_callback(files_processed, total_files)
+
+        if region is None and channels is None and levels is None:
+            objects = self._list_objects(s3, bucket, image_uuid)
+        else:
+            if levels is None:
+                levels = range(image["included"]["images"][0]["pyramid_levels"])
+            objects = self._list_selected_objects(s3, bucket, minerva_client, image_uuid, region, channels, levels)
+
+        futures = []
+        with TransferManifest(manifest_path) as manifest:
+            for obj in objects:
+                key = obj["Key"]
+                path = os.path.join(output_path, key)
+                total_files += 1
+                if manifest.is_complete(key, obj["Size"], obj["ETag"]) and os.path.exists(path) \
+                        and os.path.getsize(path) == obj["Size"]:
+                    logger.debug("Skipping key %s, already downloaded", key)
+                    with lock:
+                        files_processed += 1
+                    continue
+
+                logger.debug("Downloading key %s", key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                future = self.executor.submit(self._s3_download_file, credentials, bucket, key, str(path), self.region,
+                                              obj["ETag"], manifest, obj["Size"])
+                future.add_done_callback(done_callback)
+                futures.append(future)
+
+            concurrent.futures.wait(futures)
+
+        self.report.log_summary(logger)
+        if len(self.report.failed) > 0:
+            logger.error("%s/%s downloads failed, run the export again to resume", len(self.report.failed), total_files)
+        self.report.raise_for_failures()
+
+    def export_image_store(self, minerva_client: MinervaClient, image_uuid: str, destination, progress_callback=lambda a,b : None, max_in_flight=None):
+        """
+        Copies the objects of a zarr image directly into another store, without intermediate files.
+
+        Parameters
+        ----------
+        destination - S3Destination for copying to another bucket or prefix (server-side where possible),
+                      or a zarr store such as zarr.DirectoryStore or zarr.ZipStore
+        max_in_flight - Maximum number of objects being copied at once, defaults to twice the worker count
+        """
+        credentials, bucket, prefix = minerva_client.get_image_credentials(image_uuid)
+        s3 = self.client_pool.get(credentials)
+        self.report = TransferReport()
+        if max_in_flight is None:
+            max_in_flight = self.max_workers * 2
+
+        total_files = 0
+        files_processed = 0
+        futures = set()
+        def collect(done):
+            nonlocal files_processed
+            files_processed += len(done)
             progress_callback(files_processed, total_files)
 
-        executor = ThreadPoolExecutor(max_workers=10)
-        for obj in objs:
+        for obj in self._list_objects(s3, bucket, image_uuid):
             key = obj["Key"]
-            logger.debug("Downloading key %s", key)
-            path = os.path.join(output_path, key)
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
-            future = executor.submit(self._s3_download_file, credentials, bucket, key, str(path), self.region)
-            future.add_done_callback(done_callback)
-
-        executor.shutdown(wait=True)
-
-    def _s3_download_file(self, credentials, bucket, key, filename, region):
-        s3 = boto3.client("s3", aws_access_key_id=credentials["AccessKeyId"],
-                          aws_secret_access_key=credentials["SecretAccessKey"],
-                          aws_session_token=credentials["SessionToken"],
-                          region_name=self.region)
-        s3.download_file(Bucket=bucket, Key=key, Filename=filename)
+            relative_key = key[len(image_uuid):].lstrip("/")
+            total_files += 1
+            if len(futures) >= max_in_flight:
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            logger.debug("Copying key %s", key)
+            futures.add(self.executor.submit(self._copy_object, s3, bucket, obj, relative_key, destination))
+
+        done, _ = concurrent.futures.wait(futures)
+        collect(done)
+        self.report.log_summary(logger)
+        self.report.raise_for_failures()
+
+    def _copy_object(self, s3, bucket, obj, relative_key, destination):
+        def copy():
+            if isinstance(destination, S3Destination):
+                # S3 verifies server-side copies itself
+                destination.copy(s3, bucket, obj["Key"], relative_key)
+                return obj["Size"], False
+
+            data = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+            ratelimit.consume("download", len(data))
+            verified = False
+            if self.verify is not None:
+                verified = verify_object(s3, bucket, obj["Key"], data, obj["ETag"], self.verify)
+                if verified is False:
+                    raise ChecksumMismatch(obj["Key"])
+            destination[relative_key] = data
+            return len(data), verified
+
+        self._transfer(obj["Key"], copy)
+
+    def _transfer(self, key, transfer):
+        """
+        Runs transfer, which returns (size, verified), retrying failures and checksum mismatches.
+        The outcome is recorded in the report, the last error is raised if all attempts fail.
+        """
+        for attempt in range(self.attempts):
+            try:
+                size, verified = self.concurrency.call(transfer)
+            except Exception as e:
+                if attempt == self.attempts - 1:
+                    self.report.add_failure(key, e)
+                    raise
+                self.report.add_retry(key, e)
+                continue
+            self.report.add_success(key, size, verified)
+            return
+
+    @staticmethod
+    def _list_objects(s3, bucket, prefix, delimiter=None):
+        """
+        Yields objects under prefix page by page, so processing can start before listing completes.
+        """
+        args = {"Bucket": bucket, "Prefix": prefix, "PaginationConfig": {"PageSize": 1000}}
+        if delimiter is not None:
+            args["Delimiter"] = delimiter
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(**args):
+            for obj in page.get("Contents", []):
+                yield obj
+
+    def _list_selected_objects(self, s3, bucket, minerva_client, image_uuid, region, channels, levels):
+        """
+        Yields the group metadata, and the array metadata and chunks of the selected levels,
+        channels and region. Chunks are listed one chunk row at a time, so only keys of the
+        selection are listed.
+        """
+        prefix = image_uuid + "/"
+        yield from self._list_objects(s3, bucket, prefix, delimiter="/")
+
+        full_shape = minerva_client.get_image_array(image_uuid, 0).shape[3:5]
+        for level in levels:
+            yield from self._list_objects(s3, bucket, "{}{}/.".format(prefix, level))
+
+            array = minerva_client.get_image_array(image_uuid, level)
+            chunks = array.chunks
+            y0, x0, y1, x1 = scale_region(region, full_shape, array.shape[3:5])
+            if channels is None:
+                channel_chunks = range(math.ceil(array.shape[1] / chunks[1]))
+            else:
+                channel_chunks = sorted(set(channel // chunks[1] for channel in channels))
+            x_chunks = range(x0 // chunks[4], math.ceil(x1 / chunks[4]))
+
+            for t, c, z, y in itertools.product(range(math.ceil(array.shape[0] / chunks[0])),
+                                                channel_chunks,
+                                                range(math.ceil(array.shape[2] / chunks[2])),
+                                                range(y0 // chunks[3], math.ceil(y1 / chunks[3]))):
+                row_prefix = "{}{}/{}.{}.{}.{}.".format(prefix, level, t, c, z, y)
+                for obj in self._list_objects(s3, bucket, row_prefix):
+                    if int(obj["Key"][len(row_prefix):]) in x_chunks:
+                        yield obj
+
+    def _s3_download_file(self, credentials, bucket, key, filename, region, etag=None, manifest=None, size=None):
+        """
+        Downloads an object to a file. If a manifest is given, the download is recorded in it by the worker,
+        before the future completes, so the manifest is never closed while entries are still being added.
+        """
+        s3 = self.client_pool.get(credentials)
+        def download():
+            s3.download_file(Bucket=bucket, Key=key, Filename=filename,
+                             Callback=functools.partial(ratelimit.consume, "download"))
+            verified = False
+            if self.verify is not None:
+                # Checksum is computed in the worker thread, streaming the downloaded file
+                verified = verify_object(s3, bucket, key, filename, etag, self.verify)
+                if verified is False:
+                    raise ChecksumMismatch(key)
+            return os.path.getsize(filename), verified
+
+        self._transfer(key, download)
+        if manifest is not None:
+            manifest.add(key, size=size, etag=etag)
 
     # TODO TEST OME-TIFF EXPORT!
-    def export_image_ometiff(self, image, ome_metadata, minerva_client: MinervaClient, image_uuid: str, output_path: str, save_pyramid=False, progress_callback=lambda a,b : None):
-        start = time()
-        image, ome_metadata = self._get_image_and_metadata(minerva_client, image_uuid)
-        if image is None:
-            raise KeyError(image_uuid)
-        logger.debug(ome_metadata)
+    def export_image_ometiff(self, image, ome_metadata, minerva_client: MinervaClient, image_uuid: str, output_path: str, save_pyramid=False, progress_callback=lambda a,b : None, prefetch=32, compression=None, compression_level=None, parallel_compression=True, region=None, channels=None, levels=None):
+        """
+        Exports an image as tiled OME-TIFF. Tiles are streamed to the writer in file order, only a
+        bounded window of tiles is downloaded ahead, so memory use does not depend on the plane size.
 
+        Parameters
+        ----------
+        prefetch - Maximum number of tiles downloaded ahead of the writer
+        compression - Tile compression: zlib, zstd, lzw or jpegxr (if supported by imagecodecs), None for uncompressed
+        compression_level - Compression level, codec default if None
+        parallel_compression - Compress tiles in the download pool, so the writer thread only writes bytes
+        region - Export only a region (x, y, width, height) given in full resolution pixels
+        channels - Export only these channel indices
+        levels - Export only these pyramid levels, overrides save_pyramid. The first one is the full resolution image of the file
+        """
+        start = time()
         if output_path is None:
             output_path = image["included"]["images"][0]["name"]
             if output_path.endswith(".ome"):
@@ -97,49 +399,116 @@ class MinervaExporter:
             elif not output_path.endswith(".ome.tif"):
                 output_path += ".ome.tif"
 
-        tiles_processed = 0
-        total_tiles = 0
+        num_channels = len(image["data"]["pixels"]["channels"])
+        if levels is None:
+            pyramid_levels = image["included"]["images"][0]["pyramid_levels"] if save_pyramid else 1
+            levels = range(pyramid_levels)
+        if channels is None:
+            channels = range(num_channels)
+        tile_size = image["included"]["images"][0]["tile_size"]
+        plans = self._plan_levels(minerva_client, image_uuid, levels, channels, tile_size, region)
+        total_tiles = sum(plan.num_tiles for plan in plans)
 
-        def done_callback(f):
+        if region is not None or len(channels) != num_channels or plans[0].level != 0:
+            # Describe the exported subset instead of the whole image
+            full_width = minerva_client.get_image_array(image_uuid, 0).shape[4]
+            ome_metadata = FileUtils.subset_xml(ome_metadata, channels, plans[0].width, plans[0].height,
+                                                scale=full_width / plans[0].array.shape[4])
+
+        tiles_processed = 0
+        def tile_written():
+            nonlocal tiles_processed
+            tiles_processed += 1
             progress_callback(tiles_processed, total_tiles)
 
+        encoder = None
+        compressionargs = None
+        if compression is not None and parallel_compression:
+            encoder = self._get_tile_encoder(compression, compression_level)
+        elif compression is not None:
+            # tifffile compresses the tiles itself, so any codec it supports can be used
+            compressionargs = {"level": compression_level} if compression_level is not None else None
+
+        # One stream of tile downloads spans all channels and levels, so the next channel and level
+        # are already downloading while the current one is encoded and written
+        tiles = self._prefetch_tiles(plans, prefetch, tile_written, encoder)
+
         with tifffile.TiffWriter(output_path, bigtiff=True) as tif:
-            num_channels = len(image["data"]["pixels"]["channels"])
-            pyramid_levels = image["included"]["images"][0]["pyramid_levels"] if save_pyramid else 1
-            tile_size = image["included"]["images"][0]["tile_size"]
-            width = image["data"]["pixels"]["SizeX"]
-            height = image["data"]["pixels"]["SizeY"]
-            for level in range(pyramid_levels):
-                logger.debug("Pyramid level %s/%s", level, pyramid_levels-1)
-                tiles_width = math.ceil(width / tile_size)
-                tiles_height = math.ceil(height / tile_size)
-                total_tiles += (tiles_width*tiles_height*num_channels)
-
-                for channel in range(num_channels):
-                    logger.debug("Fetch channel %s/%s", channel, num_channels-1)
-
-                    img_level = np.zeros(shape=(height, width), dtype=np.uint16)
-                    executor = ThreadPoolExecutor(max_workers=10)
-                    for x, y in itertools.product(range(tiles_width), range(tiles_height)):
-                        f = executor.submit(self._download_tile, minerva_client, img_level, image_uuid, x, y, 0, 0, channel, level, tile_size)
-                        f.add_done_callback(done_callback)
-
-                    subfiletype = 0 if (level == 0) else 1
-                    extra_tags = [(SOFTWARE_TAG_CODE, "s", 1, "Minerva (Glencoe/Faas pyramid output)", True)]
-                    options = dict(tile=(1024, 1024))
-                    # Write metadata to first page only
-                    description = ome_metadata if (channel == 0 and level == 0) else None
-
-                    executor.shutdown(wait=True)
-                    tif.save(img_level, metadata=None, contiguous=False, subfiletype=subfiletype, description=description, extratags=extra_tags, **options)
-
-                width = math.ceil(width / 2)
-                height = math.ceil(height / 2)
+            for i, plan in enumerate(plans):
+                logger.debug("Pyramid level %s", plan.level)
+                # Reduced resolutions are written as SubIFDs of the full resolution pages (OME-TIFF pyramid)
+                subifds = len(plans) - 1 if i == 0 else None
+                subfiletype = 0 if (i == 0) else 1
+                # Write metadata to first page only
+                description = ome_metadata if i == 0 else None
+                tif.write(itertools.islice(tiles, plan.num_tiles), shape=plan.shape, dtype=plan.array.dtype,
+                          tile=plan.tile_shape, photometric="minisblack", metadata=None, contiguous=False,
+                          subifds=subifds, subfiletype=subfiletype, description=description, software=SOFTWARE,
+                          compression=compression, compressionargs=compressionargs)
 
         logger.debug("Completed - export time: %s", time() - start)
         logger.debug("Image file: %s", output_path)
         return output_path
 
+    @staticmethod
+    def _get_tile_encoder(compression, level=None):
+        name = TILE_ENCODERS.get(compression.lower())
+        encoder = getattr(imagecodecs, name, None) if name is not None else None
+        if encoder is None:
+            raise ValueError("Compression {} is not supported, use one of: {}".format(
+                compression, ", ".join(TILE_ENCODERS.keys())))
+        # LZW has no compression level
+        if level is not None and compression.lower() != "lzw":
+            encoder = functools.partial(encoder, level=level)
+        return encoder
+
+    @staticmethod
+    def _plan_levels(minerva_client, image_uuid, levels, channels, tile_size, region=None):
+        """
+        Computes the exact tile grid of each pyramid level from the stored arrays. TIFF tiles follow
+        the zarr chunks, so every tile of a chunk-aligned region is fetched with a single chunk read.
+        """
+        full_shape = minerva_client.get_image_array(image_uuid, 0).shape[3:5]
+        arrays = [minerva_client.get_image_array(image_uuid, level) for level in levels]
+        tile_shape = tuple(arrays[0].chunks[3:5])
+        if tile_shape[0] % 16 != 0 or tile_shape[1] % 16 != 0:
+            # TIFF tile dimensions must be multiples of 16
+            tile_shape = (tile_size, tile_size)
+        # Only the first level is scaled from the full resolution region, lower levels are derived from the
+        # level above with one rounding rule, otherwise rounding outwards per level breaks the pyramid
+        bounds = scale_region(region, full_shape, arrays[0].shape[3:5])
+        plans = [LevelPlan(levels[0], arrays[0], channels, tile_shape, bounds)]
+        for level, array, previous in zip(levels[1:], arrays[1:], arrays):
+            bounds = downscale_bounds(bounds, previous.shape[3:5], array.shape[3:5])
+            plans.append(LevelPlan(level, array, channels, tile_shape, bounds))
+        return plans
+
+    def _prefetch_tiles(self, plans, prefetch, tile_written, encoder=None):
+        """
+        Yields the tiles of all plans in TIFF order (level, channel, y, x), keeping at most
+        prefetch downloads queued or in flight ahead of the consumer.
+        If encoder is given, tiles are encoded in the pool and yielded as bytes.
+        """
+        window = collections.deque()
+        for plan in plans:
+            tile_height, tile_width = plan.tile_shape
+            _, _, y1, x1 = plan.bounds
+            for channel, y, x in plan.positions():
+                logger.debug("Fetch L=%s C=%s X=%s Y=%s", plan.level, channel, x, y)
+                # Tiles at the edge of the region are read only up to the region bounds
+                read_shape = (min(tile_height, y1 - y), min(tile_width, x1 - x))
+                window.append(self.executor.submit(self.concurrency.call, self._download_tile, plan.array, x, y, 0,
+                                                   0, channel, plan.tile_shape, encoder, read_shape))
+                if len(window) >= prefetch:
+                    tile = window.popleft().result()
+                    tile_written()
+                    yield tile
+
+        while len(window) > 0:
+            tile = window.popleft().result()
+            tile_written()
+            yield tile
+
     def _get_image_and_metadata(self, minerva_client, image_uuid):
         try:
             image = minerva_client.get_image_dimensions(image_uuid)
@@ -154,6 +523,13 @@ class MinervaExporter:
                 return None, None
             raise e
 
-    def _download_tile(self, minerva_client, arr, image_uuid, x, y, z, t, channel, level, tile_size):
-        tile = minerva_client.get_raw_tile(image_uuid, x, y, z, t, channel, level)
-        arr[y * tile_size:y * tile_size + tile.shape[0], x * tile_size:x * tile_size + tile.shape[1]] = tile
+    def _download_tile(self, array, x, y, z, t, channel, tile_shape, encoder=None, read_shape=None):
+        tile_height, tile_width = tile_shape
+        read_height, read_width = read_shape if read_shape is not None else tile_shape
+        tile = array[t, channel, z, y:y + read_height, x:x + read_width]
+        if tile.shape != tile_shape:
+            # Edge tiles are padded to the full tile shape expected by the TIFF writer
+            tile = np.pad(tile, ((0, tile_height - tile.shape[0]), (0, tile_width - tile.shape[1])))
+        if encoder is not None:
+            return encoder(np.ascontiguousarray(tile))
+        return tile
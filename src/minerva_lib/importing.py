@@ -1,24 +1,38 @@
 import io
 import logging, time, sys, os
+import threading
 import random, string, re
 import math
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import concurrent.futures
+import numpy as np
 import zarr
 import s3fs
 import boto3
 from tifffile import TiffFile
 import itertools
+import glob
+import collections
+import functools
+import hashlib
 
 from .client import MinervaClient
-from .util.progress import ProgressPercentage
+from .util.progress import ProgressPercentage, TransferMetrics
 from .util.s3 import S3Uploader
 from .util.fileutils import FileUtils
+from .util.integrity import VerifiedStore
+from .util.compression import make_compressor, trial_compressors, init_blosc_threads
+from .util.manifest import TransferManifest
+from .util.concurrency import AdaptiveConcurrency
+from .util.ratelimit import RateLimitedStore
 from io import BytesIO
 import uuid
 
 logger = logging.getLogger("minerva")
 
+CHECKPOINT_SUFFIX = ".minerva_checkpoint.jsonl"
+
 class TileData:
     def __init__(self, data: BytesIO, channel=0, time=0, z=0, level=0, y=0, x=0, extension="png"):
         self.data = data
@@ -40,14 +54,242 @@ class TileData:
             if value < 0:
                 raise ValueError("Values must be positive!")
 
+def default_checkpoint(file):
+    """
+    Checkpoint path for importing file, in the working directory. The name includes a hash of the absolute
+    path, so files with the same name in different directories have separate checkpoints.
+    """
+    digest = hashlib.sha1(os.path.abspath(file).encode("utf-8")).hexdigest()[:12]
+    return "{}.{}{}".format(os.path.basename(file), digest, CHECKPOINT_SUFFIX)
+
+
+def plan_blocks(height, width, chunk_shape, source_block):
+    """
+    Splits an image into blocks (y, x, height, width) in row-major order. Block dimensions are the
+    source block dimensions rounded up to whole chunks, so each block is read with few source block
+    decodes and covers complete destination chunks. For strips the block spans the full width.
+    """
+    chunk_height, chunk_width = chunk_shape
+    block_height = math.ceil(source_block[0] / chunk_height) * chunk_height
+    block_width = math.ceil(source_block[1] / chunk_width) * chunk_width
+    return [(y, x, block_height, block_width)
+            for y in range(0, height, block_height)
+            for x in range(0, width, block_width)]
+
+
+# Axes of a TIFF series which hold channels, in order of preference. Without OME metadata, planes of
+# generic multi-page files ("I" or "Q") are imported as channels.
+CHANNEL_AXES = "CSIQ"
+
+
+def axis_positions(axes):
+    """
+    Finds the T, C, Z, Y and X axes in a tifffile series axes string, e.g. "TCZYX", "ZCYX" or "YXS".
+    Missing axes are None.
+    """
+    positions = {axis: axes.index(axis) if axis in axes else None for axis in "TZYX"}
+    positions["C"] = next((axes.index(axis) for axis in CHANNEL_AXES if axis in axes), None)
+    return positions
+
+
+def get_dimensions(shape, axes):
+    """
+    Size of the T, C, Z, Y and X dimensions of an image, missing dimensions have size 1.
+    Any other axes must have size 1 as well.
+    """
+    positions = axis_positions(axes)
+    for i, axis in enumerate(axes):
+        if i not in positions.values() and shape[i] != 1:
+            raise ValueError("Unsupported axis {} of size {} in image with axes {}".format(axis, shape[i], axes))
+    return tuple(shape[positions[axis]] if positions[axis] is not None else 1 for axis in "TCZYX")
+
+
+def read_block(img, axes, t, z, channel, chunk_channels, y, x, block_height, block_width):
+    """
+    Reads a block of a plane of an image with the given axes, as an array with shape (C, Y, X).
+    """
+    positions = axis_positions(axes)
+    index = []
+    kept = []
+    for i in range(len(axes)):
+        if i == positions["Y"]:
+            index.append(slice(y, y + block_height))
+            kept.append("Y")
+        elif i == positions["X"]:
+            index.append(slice(x, x + block_width))
+            kept.append("X")
+        elif i == positions["C"]:
+            index.append(slice(channel, channel + chunk_channels))
+            kept.append("C")
+        elif i == positions["T"]:
+            index.append(t)
+        elif i == positions["Z"]:
+            index.append(z)
+        else:
+            index.append(0)
+
+    block = img[tuple(index)]
+    if "C" not in kept:
+        block = block[None]
+        kept.insert(0, "C")
+    return block.transpose([kept.index(axis) for axis in "CYX"])
+
+
+def read_block_chunks(img, axes, t, z, channel, y, x, block_height, block_width, chunks):
+    """
+    Reads a block of a plane of an image and yields the parts of it which fall into each
+    destination chunk, as (y offset, x offset, tile) relative to the block. Tiles have shape (C, Y, X).
+
+    Parameters
+    ----------
+    axes - Axes of the image, as in tifffile series
+    chunks - Chunk shape (channels, height, width)
+    """
+    chunk_channels, chunk_height, chunk_width = chunks
+    block = read_block(img, axes, t, z, channel, chunk_channels, y, x, block_height, block_width)
+
+    for chunk_y, chunk_x in itertools.product(range(0, block.shape[1], chunk_height),
+                                              range(0, block.shape[2], chunk_width)):
+        yield chunk_y, chunk_x, block[:, chunk_y:chunk_y + chunk_height, chunk_x:chunk_x + chunk_width]
+
+
+def is_empty(tile, fill_value):
+    # Constant tiles of any other value still have to be written, only the fill value is implicit
+    return tile.min() == tile.max() == fill_value
+
+
+# Source files opened in each import worker process, by path, least recently used first.
+# Batch imports interleave a few files, older files are closed once their blocks are done.
+_process_readers = collections.OrderedDict()
+MAX_PROCESS_READERS = 8
+
+
+def encode_block(file, level, t, z, channel, y, x, block_height, block_width, chunks, dtype, compressor,
+                 fill_value, skip_empty=False):
+    """
+    Runs in an import worker process. Reads a block of a TIFF level and encodes every zarr chunk it covers,
+    so only the compressed chunks are returned to the parent process instead of decoded arrays.
+
+    Returns
+    -------
+    List of (y, x, encoded chunk) with y and x relative to the block, encoded chunk is None for skipped empty
+    chunks. Number of decoded bytes.
+    """
+    reader = _process_readers.get(file)
+    if reader is None:
+        reader = _process_readers[file] = TiffReader(file)
+        if len(_process_readers) > MAX_PROCESS_READERS:
+            _process_readers.popitem(last=False)[1].close()
+    else:
+        _process_readers.move_to_end(file)
+
+    encoded = []
+    nbytes = 0
+    for chunk_y, chunk_x, tile in read_block_chunks(reader.level(level), reader.axes(level), t, z, channel, y, x,
+                                                    block_height, block_width, chunks):
+        nbytes += tile.nbytes
+        if skip_empty and is_empty(tile, fill_value):
+            encoded.append((chunk_y, chunk_x, None))
+            continue
+        if tile.shape != tuple(chunks):
+            # Zarr chunks always have the full chunk shape, edge chunks are padded with the fill value
+            padded = np.full(chunks, fill_value, dtype=dtype)
+            padded[:tile.shape[0], :tile.shape[1], :tile.shape[2]] = tile
+            tile = padded
+        tile = np.ascontiguousarray(tile, dtype=dtype)
+        encoded.append((chunk_y, chunk_x, compressor.encode(tile) if compressor is not None else tile.tobytes()))
+    return encoded, nbytes
+
+
+class TiffReader:
+    """
+    Reads pyramid levels of a TIFF file as zarr arrays. Every thread gets its own file handle,
+    so worker threads read and decode tiles in parallel instead of serializing on one handle.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        tif = getattr(self._local, "tif", None)
+        if tif is None:
+            # OME metadata is parsed, so the series has T, C and Z axes instead of a flat list of planes
+            tif = TiffFile(self.file)
+            with self._lock:
+                self._handles.append(tif)
+            self._local.group_or_array = zarr.open(tif.aszarr())
+            self._local.tif = tif
+        return tif
+
+    def level(self, level):
+        self._open()
+        group_or_array = self._local.group_or_array
+        if isinstance(group_or_array, zarr.core.Array):
+            return group_or_array
+        return group_or_array[level]
+
+    def axes(self, level):
+        """
+        Axes of a pyramid level, e.g. "TCZYX"
+        """
+        return self._open().series[0].levels[level].axes
+
+    def close(self):
+        with self._lock:
+            for tif in self._handles:
+                tif.close()
+            self._handles.clear()
+
+
+class ImportJob:
+    """
+    State of the import of one ome.tif file.
+    """
+
+    def __init__(self, file, image_uuid, tif, levels, completed, checkpoint, credentials, bucket, prefix, metrics):
+        self.file = file
+        self.image_uuid = image_uuid
+        self.tif = tif
+        self.reader = TiffReader(file)
+        self.levels = levels
+        self.completed = completed
+        self.checkpoint = checkpoint
+        self.credentials = credentials
+        self.bucket = bucket
+        self.prefix = prefix
+        self.metrics = metrics
+        self.verify = False
+        self.total_tiles = 0
+        self.tiles_processed = 0
+        self.pending = 0
+        self.failures = 0
+
+
 class MinervaImporter:
 
-    def __init__(self, minerva_client: MinervaClient, uploader: S3Uploader, region="us-east-1", dryrun=False):
+    def __init__(self, minerva_client: MinervaClient, uploader: S3Uploader, region="us-east-1", dryrun=False,
+                 concurrency: AdaptiveConcurrency=None):
+        """
+        Parameters
+        ----------
+        minerva_client - MinervaClient
+        uploader - S3Uploader
+        region - AWS region
+        dryrun - Write client-side imports to ./zarrtmp instead of S3
+        concurrency - AdaptiveConcurrency which limits concurrent tile imports, can be shared with an exporter.
+            By default the uploader's controller, or a new one if the uploader has none.
+        """
         self.minerva_client = minerva_client
         self.uploader = uploader
         self.region = region
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        if concurrency is None:
+            concurrency = getattr(uploader, "concurrency", None) or AdaptiveConcurrency()
+        self.concurrency = concurrency
         self.dryrun = dryrun
+        self.metrics = TransferMetrics()
 
     def import_files(self, files, repository=None, archive=False):
         repository_uuid = self._create_or_get_repository(repository, archive)
@@ -59,8 +301,12 @@ class MinervaImporter:
         logger.info("Uploading to S3 bucket: %s/%s", bucket, prefix)
 
         # Upload all files in parallel to S3
+        self.uploader.reset_report()
         self._upload_raw_files(files, bucket, prefix, credentials)
 
+        # Do not mark a partial import complete
+        self.uploader.report.log_summary(logger)
+        self.uploader.report.raise_for_failures()
         self.minerva_client.mark_import_complete(import_uuid)
         return import_uuid
 
@@ -89,7 +335,7 @@ class MinervaImporter:
         if not async_upload:
             self.uploader.upload_data(tile_data.data, bucket, key, credentials)
         else:
-            self.executor.submit(self.uploader.upload_data, tile_data.data, bucket, key, credentials)
+            return self.uploader.upload_data_async(tile_data.data, bucket, key, credentials)
 
     def direct_import_files(self, files, image_uuid, async_upload=False):
         credentials, bucket, prefix = self._get_image_credentials(image_uuid)
@@ -97,12 +343,73 @@ class MinervaImporter:
         logger.debug("Bucket %s", bucket)
         logger.debug("Prefix %s", prefix)
 
+        futures = []
         for file in files:
             key = prefix + "/" + os.path.basename(file)
             if not async_upload:
                 self.uploader.upload_file(file, bucket, key, credentials)
             else:
-                self.executor.submit(self.uploader.upload_file, file, bucket, key, credentials)
+                futures.append(self.uploader.upload_file_async(file, bucket, key, credentials))
+        return futures
+
+    def import_tile_directory(self, dir, image_uuid, pattern=None, validate=True, max_in_flight=256,
+                              progress_callback=lambda a,b : None, max_workers=None):
+        """
+        Imports a directory of pre-tiled images named like C0-T0-Z0-L0-Y0-X0.png into an existing image.
+        Tile headers are validated in parallel and at most max_in_flight uploads are pending at any time,
+        so directories of many thousands of tiles are uploaded concurrently without queuing every file.
+
+        Parameters
+        ----------
+        dir - Directory of tiles
+        image_uuid - Image uuid
+        pattern - Regular expression for tile file names, by default C-T-Z-L-Y-X
+        validate - Check that every tile is a 16-bit grayscale png before uploading
+        max_in_flight - Maximum number of pending uploads
+        progress_callback - Callback function to report progress, called with uploaded and total tiles
+        max_workers - Number of threads validating tile headers, by default the concurrency maximum
+
+        Returns
+        -------
+        Number of tiles
+        """
+        if pattern is None:
+            pattern = FileUtils._file_pattern
+        files = FileUtils.scan_files_regex(dir, pattern)
+        if validate:
+            # Only a few header bytes are read per tile, so validation is bound by file open latency
+            if max_workers is None:
+                max_workers = self.concurrency.maximum
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for _ in executor.map(FileUtils.validate_tile, files):
+                    pass
+
+        credentials, bucket, prefix = self._get_image_credentials(image_uuid)
+        self.uploader.reset_report()
+        pending = collections.deque()
+        uploaded = 0
+        for file in files:
+            if len(pending) >= max_in_flight:
+                uploaded += self._wait_tile_upload(pending.popleft())
+                progress_callback(uploaded, len(files))
+            key = prefix + "/" + os.path.basename(file)
+            pending.append(self.uploader.upload_file_async(file, bucket, key, credentials))
+        while pending:
+            uploaded += self._wait_tile_upload(pending.popleft())
+            progress_callback(uploaded, len(files))
+
+        self.uploader.report.log_summary(logger)
+        self.uploader.report.raise_for_failures()
+        return len(files)
+
+    @staticmethod
+    def _wait_tile_upload(future):
+        try:
+            future.result()
+        except Exception as e:
+            # Failures are recorded in the transfer report
+            logger.debug(e)
+        return 1
 
     def direct_import_metadata(self, metadata, image_uuid, credentials=None, bucket=None, prefix=None):
         if self.dryrun:
@@ -118,7 +425,7 @@ class MinervaImporter:
         self.uploader.upload_data(xml, bucket, prefix + '/metadata.xml', credentials)
 
     def wait_upload(self):
-        self.executor.shutdown(wait=True)
+        self.uploader.wait_upload()
 
     def _create_or_get_repository(self, repository, archive=False):
         res = self.minerva_client.list_repositories()
@@ -158,10 +465,17 @@ class MinervaImporter:
         for file in files:
             progress._total_size += os.path.getsize(file)
 
-        with ThreadPoolExecutor() as executor:
-            for file in files:
-                key = prefix + FileUtils.get_key(file)
-                executor.submit(self.uploader.upload_file, file, bucket, key, credentials, progress)
+        futures = []
+        for file in files:
+            key = prefix + FileUtils.get_key(file)
+            futures.append(self.uploader.upload_file_async(file, bucket, key, credentials, progress))
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                # Recorded in the uploader's report
+                pass
 
         sys.stdout.write("\r\n")
 
@@ -210,30 +524,16 @@ class MinervaImporter:
             progress = p[1]
             sys.stdout.write("{} {}% ".format(fileset["name"], progress))
 
-    def _get_dimensions(self, level):
-        if len(level.shape) == 3:
-            channels = level.shape[0]
-            height = level.shape[1]
-            width = level.shape[2]
-        else:
-            channels = 1
-            height = level.shape[0]
-            width = level.shape[1]
-
-        return channels, height, width
-
-    def _calculate_total_tiles(self, group):
-        total_tiles = 0
-        for name in group:
-            level = group[name]
-            channels, height, width = self._get_dimensions(level)
-            total_tiles += channels * math.ceil(height / 1024) * math.ceil(width / 1024)
-
-        return total_tiles
+    def _calculate_total_tiles(self, arrays):
+        return sum(arr.nchunks for arr in arrays)
 
-    def import_ome_tiff(self, file, repository, tile_size=1024, progress_callback=lambda a,b : None, image_name=None):
+    def import_ome_tiff(self, file, repository, tile_size=1024, progress_callback=lambda a,b : None, image_name=None,
+                        chunks=None, compression="zstd", compression_level=3, shuffle="byte", blosc_threads=None,
+                        max_in_flight_bytes=256 * 1024 * 1024, skip_empty=False, resume=False, checkpoint=None,
+                        image_uuid=None, processes=None):
         """
         Processes an ome.tif client side and imports it directly into S3 tilebucket.
+        Time points, channels and z-sections are taken from the OME series axes and written as (T, C, Z, Y, X).
 
         Parameters
         ----------
@@ -242,108 +542,482 @@ class MinervaImporter:
         tile_size - Tile size, default 1024
         progress_callback - Callback function to report progress
         image_name - Image name, by default is taken from the filename
+        chunks - Zarr chunk shape as (channels, height, width), default (1, tile_size, tile_size)
+        compression - Blosc codec (zstd, lz4, lz4hc, zlib, blosclz) or "none", see trial_compression
+        compression_level - Compression level 0-9
+        shuffle - Blosc shuffle filter: none, byte, bit or auto. Bit shuffle often compresses 16-bit images better.
+        blosc_threads - Number of internal Blosc threads each worker process compresses a chunk with,
+            requires processes. Worker threads always compress single-threaded.
+        max_in_flight_bytes - Budget for decoded image data read but not yet uploaded, bounds import memory.
+            At least one block is always in flight, even if it is larger than the budget.
+        skip_empty - Do not write chunks in which every pixel equals the fill value (0). Zarr reads missing chunks
+            as the fill value, so the image is unchanged while background chunks cost no upload.
+        resume - Continue an interrupted import. Blocks recorded in the checkpoint are skipped and the image is
+            written into the existing zarr group instead of replacing it. If False, any old checkpoint is removed.
+        checkpoint - Path of the checkpoint file which records completed blocks, by default the file name with
+            a hash of its path and suffix .minerva_checkpoint.jsonl in the working directory. It is removed when
+            the import succeeds.
+        image_uuid - Existing image to import into, by default the image recorded in the checkpoint when
+            resuming, otherwise a new image is created
+        processes - Number of worker processes which decode and compress blocks, for CPU-bound imports on many
+            cores. Worker processes open the file themselves and return compressed chunks. If None, blocks are
+            decoded and compressed in the worker threads.
+
+        Returns
+        -------
+        Image uuid
         """
-        if image_name is None:
-            image_name = os.path.basename(file)
+        if chunks is None:
+            chunks = (1, tile_size, tile_size)
+        compressor = make_compressor(compression, compression_level, shuffle)
+        options = dict(tile_size=tile_size, chunks=chunks, compression=compression, compressor=compressor,
+                       resume=resume)
+        self.metrics = TransferMetrics()
+        self.uploader.reset_report()
+
+        process_pool = self._create_process_pool(processes, blosc_threads)
+        executor = ThreadPoolExecutor(max_workers=max(self.concurrency.maximum, processes or 0))
+        job = self._start_ome_tiff_import(file, repository, image_name=image_name, checkpoint=checkpoint,
+                                          image_uuid=image_uuid, dryrun_path="./zarrtmp", **options)
+        self._run_import_jobs(iter([job]), executor, 1, max_in_flight_bytes, skip_empty, progress_callback,
+                              process_pool)
+        executor.shutdown()
+        if process_pool is not None:
+            process_pool.shutdown()
+        self.uploader.report.raise_for_failures()
+        return job.image_uuid
+
+    def import_ome_tiffs(self, files, repository, tile_size=1024, progress_callback=lambda a,b : None,
+                         max_workers=None, interleave=4, chunks=None, compression="zstd", compression_level=3,
+                         shuffle="byte", blosc_threads=None, max_in_flight_bytes=256 * 1024 * 1024,
+                         skip_empty=False, resume=False, processes=None):
+        """
+        Imports many ome.tif files client side with a single worker pool. Blocks of several files are
+        interleaved, so the pool stays busy while a file is being opened or finished.
+        Images are named after their files. A file whose import fails does not stop the others, its checkpoint
+        is kept for resuming and TransferFailed is raised after all files have been processed.
 
-        executor = ThreadPoolExecutor(max_workers=10)
-        # limit the queue of pending uploads to 100
-        queue_limit = 100
-        futures = set()
+        Parameters
+        ----------
+        files - File paths or glob patterns
+        repository - Repository name
+        tile_size - Tile size, default 1024
+        progress_callback - Callback function to report progress, counts chunks of all files opened so far
+        max_workers - Number of worker threads shared by all files, by default the concurrency maximum
+        interleave - Number of files imported at the same time
+        chunks, compression, compression_level, shuffle, blosc_threads, max_in_flight_bytes, skip_empty, resume,
+            processes - As for import_ome_tiff, applied to every file. The byte budget and worker processes are
+            shared by all files.
+
+        Returns
+        -------
+        Dict of image uuids by file path
+        """
+        paths = []
+        for pattern in files:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise FileNotFoundError(pattern)
+            paths.extend(matches)
+
+        if chunks is None:
+            chunks = (1, tile_size, tile_size)
+        compressor = make_compressor(compression, compression_level, shuffle)
+        options = dict(tile_size=tile_size, chunks=chunks, compression=compression, compressor=compressor,
+                       resume=resume)
+        self.metrics = TransferMetrics()
+        self.uploader.reset_report()
+
+        jobs = []
+        def start_jobs():
+            for path in paths:
+                try:
+                    job = self._start_ome_tiff_import(path, repository, **options)
+                except Exception as e:
+                    # A file which cannot be opened or created is reported, the other files are still imported
+                    self.uploader.report.add_failure(path, e)
+                    continue
+                jobs.append(job)
+                yield job
+
+        if max_workers is None:
+            max_workers = self.concurrency.maximum
+        process_pool = self._create_process_pool(processes, blosc_threads)
+        executor = ThreadPoolExecutor(max_workers=max(max_workers, processes or 0))
+        self._run_import_jobs(start_jobs(), executor, interleave, max_in_flight_bytes, skip_empty,
+                              progress_callback, process_pool)
+        executor.shutdown()
+        if process_pool is not None:
+            process_pool.shutdown()
+
+        logger.info("Imported %s files, %s bytes at %.1f MB/s, concurrency %s", len(jobs),
+                    self.metrics.completed_bytes, self.metrics.throughput() / 1e6, self.concurrency.limit)
+        self.uploader.report.raise_for_failures()
+        return {job.file: job.image_uuid for job in jobs}
 
-        with TiffFile(file, is_ome=False) as tif:
+    @staticmethod
+    def _create_process_pool(processes, blosc_threads=None):
+        if processes is None:
+            if blosc_threads is not None:
+                raise ValueError("blosc_threads requires worker processes")
+            return None
+        initializer, initargs = (init_blosc_threads, (blosc_threads,)) if blosc_threads is not None else (None, ())
+        # Worker threads of the parent are running, so processes are spawned instead of forked
+        return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=initializer, initargs=initargs)
+
+    def _start_ome_tiff_import(self, file, repository, tile_size, chunks, compression, compressor, resume,
+                               image_name=None, checkpoint=None, image_uuid=None, dryrun_path=None):
+        """
+        Opens an ome.tif, creates or resumes its image and creates the zarr arrays of every level.
+        """
+        if image_name is None:
+            image_name = os.path.basename(file)
+        if checkpoint is None:
+            checkpoint = default_checkpoint(file)
+        if not resume and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        # OME metadata is parsed, so the series has T, C and Z axes instead of a flat list of planes
+        tif = TiffFile(file)
+        completed = None
+        try:
             # Depending on whether the image contains pyramid or not,
             # this will either be Zarr Group or Array
             group_or_array = zarr.open(tif.aszarr())
 
             if isinstance(group_or_array, zarr.core.Array):
-                i = 0 if len(group_or_array.shape) == 2 else 1
-                if group_or_array.shape[i] > tile_size and group_or_array.shape[i+1] > tile_size:
+                _, _, _, height, width = get_dimensions(group_or_array.shape, tif.series[0].axes)
+                if height > tile_size and width > tile_size:
                     logger.error("Local importing of images without pyramid is not currently supported. Use server-side importing instead.")
                     raise ValueError("Image is larger than TILE_SIZE but does not contain pyramid levels.")
                 num_levels = 1
             else:
                 num_levels = len(group_or_array)
 
-            image_uuid = self.create_image(image_name,
-                                           repository,
-                                           format="zarr",
-                                           compression="zstd",
-                                           pyramid_levels=num_levels,
-                                           tile_size=tile_size)
+            completed = TransferManifest(checkpoint)
+            if image_uuid is None and "image" in completed.entries:
+                image_uuid = completed.entries["image"]["image_uuid"]
+                logger.info("Resuming import of %s into image %s, %s blocks completed", file, image_uuid,
+                            len(completed.entries) - 1)
+            if image_uuid is None:
+                image_uuid = self.create_image(image_name,
+                                               repository,
+                                               format="zarr",
+                                               compression=compression,
+                                               pyramid_levels=num_levels,
+                                               tile_size=tile_size)
+            if "image" not in completed.entries:
+                completed.add("image", image_uuid=str(image_uuid))
 
             credentials, bucket, prefix = self._get_image_credentials(image_uuid)
 
-            total_tiles = self._calculate_total_tiles(group_or_array)
-            tiles_processed = 0
-            def done_callback(f):
-                progress_callback(tiles_processed, total_tiles)
-
-            compressor = zarr.Blosc(cname='zstd', clevel=3)
-
             s3 = s3fs.S3FileSystem(anon=self.dryrun,
                                    client_kwargs=dict(region_name=self.region),
                                    key=credentials["AccessKeyId"],
                                    secret=credentials["SecretAccessKey"],
                                    token=credentials["SessionToken"])
 
+            verify = self.uploader.verify is not None and not self.dryrun
             if not self.dryrun:
                 zarr_store = s3fs.S3Map(root=f"{bucket}/{prefix}", s3=s3, check=False, create=False)
             else:
-                zarr_store = zarr.DirectoryStore("./zarrtmp")
+                zarr_store = zarr.DirectoryStore(dryrun_path or os.path.join("./zarrtmp", str(image_uuid)))
+
+            if verify:
+                # Every chunk written is compared with the object stored in S3 and recorded in the report
+                zarr_store = VerifiedStore(zarr_store, self.uploader.client_pool.get(credentials), bucket, prefix,
+                                           self.uploader.report, self.uploader.verify)
+
+            # Chunk writes count against the process-wide upload bandwidth limit
+            zarr_store = RateLimitedStore(zarr_store)
 
             # In OME-ZARR each pyramid level will be stored as a separate zarr Array, named by
             # the index number of the level, e.g. "0" is highest detail level
             # All Arrays are stored under a zarr Group.
-            output = zarr.group(store=zarr_store, overwrite=True)
+            # When resuming, the group and arrays written so far are kept
+            output = zarr.group(store=zarr_store, overwrite=not resume)
 
+            levels = []
             for pyramid_level in range(num_levels):
                 if isinstance(group_or_array, zarr.core.Array):
                     img = group_or_array
                 else:
                     img = group_or_array[pyramid_level]
 
-                num_channels, height, width = self._get_dimensions(img)
-
-                tiles_height = math.ceil(img.shape[1] / tile_size)
-                tiles_width = math.ceil(img.shape[2] / tile_size)
-
-                arr = output.create(shape=(1, num_channels, 1, height, width), chunks=(1, 1, 1, 1024, 1024),
-                                    name=str(pyramid_level), dtype=img.dtype, compressor=compressor)
-
-                # TODO - Handle t and z dimensions
-                t = 0
-                z = 0
-                channels_range = range(num_channels)
-                x_range = range(0, tiles_width)
-                y_range = range(0, tiles_height)
+                axes = tif.series[0].levels[pyramid_level].axes
+                size_t, num_channels, size_z, height, width = get_dimensions(img.shape, axes)
+
+                level_chunks = (1, min(chunks[0], num_channels), 1, chunks[1], chunks[2])
+                arr = output.require_dataset(shape=(size_t, num_channels, size_z, height, width), chunks=level_chunks,
+                                             name=str(pyramid_level), dtype=img.dtype, compressor=compressor,
+                                             exact=True)
+                if arr.chunks != level_chunks:
+                    raise ValueError("Cannot resume level {} with chunks {}, it was written with chunks {}".format(
+                        pyramid_level, level_chunks, arr.chunks))
+
+                # Blocks follow the source layout (tiles or strips), so every source block is decoded
+                # once or twice at most, and cover whole destination chunks
+                source_block = self._get_source_block(tif, pyramid_level, height, width)
+                blocks = plan_blocks(height, width, arr.chunks[3:5], source_block)
+                logger.debug("Level %s axes %s, source blocks %s, import blocks %s", pyramid_level, axes, source_block,
+                             blocks[0][2:])
+                levels.append((pyramid_level, arr, blocks))
+
+            job = ImportJob(file, image_uuid, tif, levels, completed, checkpoint, credentials, bucket, prefix,
+                            TransferMetrics(self.metrics))
+            job.verify = verify
+            job.total_tiles = self._calculate_total_tiles(arr for _, arr, _ in levels)
+            return job
+        except Exception:
+            # The file is not imported, so nothing it opened is left behind
+            tif.close()
+            if completed is not None:
+                completed.close()
+            raise
+
+    def _import_blocks(self, job):
+        """
+        Yields the blocks of a file which are not recorded in its checkpoint, as (arguments of _import_block,
+        decoded bytes, checkpoint key, report key, number of chunks). Completed blocks yield None.
+        """
+        for pyramid_level, arr, blocks in job.levels:
+            size_t, num_channels, size_z, height, width = arr.shape
+            chunk_channels = arr.chunks[1]
+            chunk_height, chunk_width = arr.chunks[3:5]
+            # Channels which share a chunk are read and written together. Every plane is split into blocks
+            # in the same way, so blocks of all planes are imported in parallel.
+            channels_range = range(0, num_channels, chunk_channels)
+            for t, z, channel, (y, x, block_height, block_width) in itertools.product(range(size_t), range(size_z),
+                                                                                      channels_range, blocks):
+                num_chunks = math.ceil(min(block_height, height - y) / chunk_height) * \
+                    math.ceil(min(block_width, width - x) / chunk_width)
+                checkpoint_key = "{}/{}.{}.{}.{}.{}".format(pyramid_level, t, channel, z, y, x)
+                if job.completed.is_complete(checkpoint_key):
+                    job.tiles_processed += num_chunks
+                    yield None
+                    continue
+
+                logger.debug("Processing %s L=%s T=%s C=%s Z=%s X=%s Y=%s", job.file, pyramid_level, t, channel, z,
+                             x, y)
+                block_bytes = min(chunk_channels, num_channels - channel) * min(block_height, height - y) * \
+                    min(block_width, width - x) * arr.dtype.itemsize
+                block_key = "{}/{}/{}.{}.{}.{}-{}.{}-{}".format(
+                    job.prefix, pyramid_level, t, channel // chunk_channels, z, y // chunk_height,
+                    math.ceil((y + block_height) / chunk_height) - 1, x // chunk_width,
+                    math.ceil((x + block_width) / chunk_width) - 1)
+                arguments = (job.reader, pyramid_level, arr, t, channel, z, y, x, block_height, block_width)
+                yield arguments, block_bytes, checkpoint_key, block_key, num_chunks
+
+    def _run_import_jobs(self, jobs, executor, interleave, max_in_flight_bytes, skip_empty, progress_callback,
+                         process_pool=None):
+        """
+        Imports blocks of up to interleave files at a time in round-robin order with a shared byte budget.
+        Each file is finished as soon as all of its blocks are done. With a process pool the worker threads
+        only write the chunks which were encoded in the worker processes.
 
-                for channel, tile_x, tile_y in itertools.product(channels_range, x_range, y_range):
-                    logger.debug("Processing L=%s C=%s X=%s Y=%s", pyramid_level, channel, tile_x, tile_y)
-                    x = tile_x * tile_size
-                    y = tile_y * tile_size
-                    tile = img[channel, y:y + tile_size, x:x + tile_size]
+        Every chunk of a block is written as a separate task of a writer pool and counts against the
+        concurrency limit, so a few large blocks (e.g. full-width strips) still upload many chunks at once.
+        """
+        import_block = self._import_block
+        if process_pool is not None:
+            import_block = functools.partial(self._import_block_in_process, process_pool)
+        # Block workers wait for their chunk writes, so writes need threads of their own
+        write_executor = ThreadPoolExecutor(max_workers=self.concurrency.maximum)
+        report = self.uploader.report
+        # Decoded bytes of each pending block, the queue is limited by their sum instead of the number of blocks
+        in_flight = {}
+        active = []
+        started = []
+        draining = []
+
+        def release(done):
+            # Outcomes are recorded here on the main thread, before a file can be finished. Done callbacks
+            # could still be running when wait() returns.
+            for future in done:
+                job, block_bytes, checkpoint_key, block_key = in_flight.pop(future)
+                self._record_block(report, job, checkpoint_key, block_key, future)
+                job.metrics.complete(block_bytes)
+                job.pending -= 1
+            for job in [job for job in draining if job.pending == 0]:
+                draining.remove(job)
+                self._finish_ome_tiff_import(job)
+
+        while True:
+            while len(active) < interleave:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                started.append(job)
+                active.append((job, self._import_blocks(job)))
+            if not active:
+                break
+
+            for entry in list(active):
+                job, blocks = entry
+                block = next(blocks, False)
+                if block is False:
+                    active.remove(entry)
+                    draining.append(job)
+                    release([])
+                    continue
+                if block is not None:
+                    arguments, block_bytes, checkpoint_key, block_key, num_chunks = block
+                    while in_flight and self.metrics.in_flight_bytes + block_bytes > max_in_flight_bytes:
+                        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        release(done)
+                    # Reading and decoding the block happens in the worker, chunks are encoded and uploaded
+                    # by the writer pool
+                    future = executor.submit(import_block, *arguments, skip_empty, job.metrics, write_executor)
+                    in_flight[future] = (job, block_bytes, checkpoint_key, block_key)
+                    job.pending += 1
+                    job.metrics.submit(block_bytes)
+                    job.tiles_processed += num_chunks
+                progress_callback(sum(job.tiles_processed for job in started),
+                                  sum(job.total_tiles for job in started))
+
+        concurrent.futures.wait(in_flight)
+        release(list(in_flight))
+        write_executor.shutdown()
+
+    def _finish_ome_tiff_import(self, job):
+        job.completed.close()
+        job.reader.close()
+        logger.info("Imported %s: %s bytes at %.1f MB/s, peak %s bytes in flight, %s empty chunks skipped",
+                    job.file, job.metrics.completed_bytes, job.metrics.throughput() / 1e6,
+                    job.metrics.peak_in_flight_bytes, job.metrics.skipped)
+        self.uploader.report.log_summary(logger)
+
+        if job.failures:
+            logger.error("Import of %s failed, %s blocks failed. Resume with the checkpoint %s", job.file,
+                         job.failures, job.checkpoint)
+            job.tif.close()
+            return
 
-                    if len(futures) >= queue_limit:
-                        done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
-                    future = executor.submit(self._upload_zarr, arr, t, channel, z, y, x, tile_size, tile)
-                    futures.add(future)
+        # Metadata.xml has to be uploaded after zarr upload, otherwise zarr will overwrite
+        # the whole key
+        metadata = job.tif.pages[0].tags['ImageDescription'].value
+        job.tif.close()
+        self.direct_import_metadata(metadata,
+                                    job.image_uuid,
+                                    credentials=job.credentials,
+                                    bucket=job.bucket,
+                                    prefix=job.prefix)
+        os.remove(job.checkpoint)
+
+    def trial_compression(self, file, candidates=None, num_samples=4, tile_size=1024):
+        """
+        Compresses a few tiles sampled from the highest resolution level of an ome.tif with each candidate
+        codec and logs the compression ratio and encode speed, to choose import_ome_tiff compression options.
 
-                    progress_callback(tiles_processed, total_tiles)
-                    tiles_processed += 1
+        Parameters
+        ----------
+        file - File path
+        candidates - List of (compression, level, shuffle) tuples, by default a small set of common codecs
+        num_samples - Number of tiles sampled along the image diagonal
+        tile_size - Tile size
 
-            # Metadata.xml has to be uploaded after zarr upload, otherwise zarr will overwrite
-            # the whole key
-            metadata = tif.pages[0].tags['ImageDescription'].value
-            self.direct_import_metadata(metadata,
-                                        image_uuid,
-                                        credentials=credentials,
-                                        bucket=bucket,
-                                        prefix=prefix)
+        Returns
+        -------
+        List of dicts with compression, level, shuffle, ratio and encode_mb_s, best ratio first
+        """
+        reader = TiffReader(file)
+        try:
+            img = reader.level(0)
+            axes = reader.axes(0)
+            size_t, channels, size_z, height, width = get_dimensions(img.shape, axes)
+            tiles = []
+            for i in range(num_samples):
+                y = min(height * (2 * i + 1) // (2 * num_samples), max(height - tile_size, 0))
+                x = min(width * (2 * i + 1) // (2 * num_samples), max(width - tile_size, 0))
+                tiles.append(read_block(img, axes, i % size_t, i % size_z, i % channels, 1, y, x, tile_size,
+                                        tile_size)[0])
+        finally:
+            reader.close()
+
+        results = trial_compressors(tiles, candidates)
+        for result in results:
+            logger.info("%(compression)s level=%(level)s shuffle=%(shuffle)s ratio=%(ratio).2f "
+                        "encode=%(encode_mb_s).1f MB/s", result)
+        return results
 
-        executor.shutdown()
+    @staticmethod
+    def _get_source_block(tif, level, height, width):
+        """
+        Shape of the blocks (tiles or strips) a level of the source TIFF is stored in.
+        """
+        page = tif.series[0].levels[level].keyframe
+        if page.is_tiled:
+            return page.tilelength, page.tilewidth
+        return min(page.rowsperstrip, height), width
 
+    def _import_block(self, reader, level, arr, t, channel, z, y, x, block_height, block_width, skip_empty=False,
+                      metrics=None, write_executor=None):
+        """
+        Reads a block of the source image once and writes every destination chunk it covers.
+        """
+        nbytes = 0
+        chunks = (arr.chunks[1],) + arr.chunks[3:5]
+        writes = []
+        for chunk_y, chunk_x, tile in read_block_chunks(reader.level(level), reader.axes(level), t, z, channel, y,
+                                                        x, block_height, block_width, chunks):
+            nbytes += tile.nbytes
+            if skip_empty and is_empty(tile, arr.fill_value):
+                if metrics is not None:
+                    metrics.skip()
+                continue
+            writes.append(functools.partial(self._upload_zarr, arr, t, channel, z, y + chunk_y, x + chunk_x, tile))
+        self._write_chunks(write_executor, writes)
+        return nbytes
+
+    def _write_chunks(self, write_executor, writes):
+        """
+        Runs the chunk writes of a block, each counted as one transfer against the concurrency limit.
+        Waits for all of them, so a failed block leaves no writes behind, and raises the first error.
+        """
+        if write_executor is None:
+            for write in writes:
+                self.concurrency.call(write)
+            return
+        futures = [write_executor.submit(self.concurrency.call, write) for write in writes]
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
 
+    def _import_block_in_process(self, process_pool, reader, level, arr, t, channel, z, y, x, block_height,
+                                 block_width, skip_empty=False, metrics=None, write_executor=None):
+        """
+        Decodes and encodes a block in a worker process, then writes the encoded chunks to the store.
+        """
+        chunks = (arr.chunks[1],) + arr.chunks[3:5]
+        future = process_pool.submit(encode_block, reader.file, level, t, z, channel, y, x, block_height,
+                                     block_width, chunks, arr.dtype, arr.compressor, arr.fill_value, skip_empty)
+        encoded, nbytes = future.result()
+        chunk_channels, chunk_height, chunk_width = chunks
+        writes = []
+        for chunk_y, chunk_x, data in encoded:
+            if data is None:
+                if metrics is not None:
+                    metrics.skip()
+                continue
+            key = "{}.{}.{}.{}.{}".format(t, channel // chunk_channels, z, (y + chunk_y) // chunk_height,
+                                          (x + chunk_x) // chunk_width)
+            writes.append(functools.partial(arr.store.__setitem__, arr.path + "/" + key if arr.path else key, data))
+        self._write_chunks(write_executor, writes)
+        return nbytes
+
+    def _upload_zarr(self, arr, t, channel, z, y, x, tile):
+        arr[t, channel:channel + tile.shape[0], z, y:y + tile.shape[1], x:x + tile.shape[2]] = tile
 
-    def _upload_zarr(self, arr, t, channel, z, y, x, tile_size, tile):
-        arr[t, channel, z, y:y + tile_size, x:x + tile_size] = tile
+    @staticmethod
+    def _record_block(report, job, checkpoint_key, block_key, future):
+        error = future.exception()
+        if error is not None:
+            job.failures += 1
+            # Also with verification, a block can fail before any chunk reaches the VerifiedStore
+            report.add_failure(block_key, error)
+            return
+        job.completed.add(checkpoint_key)
+        if not job.verify:
+            # With verification every chunk is recorded by the VerifiedStore instead
+            report.add_success(block_key, future.result(), verified=False)
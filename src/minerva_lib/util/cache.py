@@ -0,0 +1,88 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class CacheEntry:
+    def __init__(self, value, etag=None, timestamp=None):
+        self.value = value
+        self.etag = etag
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+
+class ResponseCache:
+    """
+    Thread-safe TTL cache for API responses, with an optional on-disk tier.
+    Entries are kept after expiring, so that their ETag can still be used for revalidation.
+    """
+
+    def __init__(self, ttl=300, cache_dir=None, revalidate=False):
+        """
+        Parameters
+        ----------
+        ttl - Time in seconds for which an entry is served without contacting the server
+        cache_dir - Directory for persisting entries across processes, disabled if None
+        revalidate - Revalidate expired entries using their ETag (If-None-Match)
+        """
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.revalidate = revalidate
+        self._entries = {}
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and self.cache_dir is not None:
+            entry = self._read_disk(key)
+            if entry is not None:
+                with self._lock:
+                    self._entries[key] = entry
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry.timestamp < self.ttl
+
+    def put(self, key, value, etag=None):
+        entry = CacheEntry(value, etag)
+        with self._lock:
+            self._entries[key] = entry
+        if self.cache_dir is not None:
+            self._write_disk(key, entry)
+
+    def touch(self, key):
+        entry = self.get(key)
+        if entry is not None:
+            self.put(key, entry.value, entry.etag)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                data = json.load(f)
+            return CacheEntry(data["value"], data["etag"], data["timestamp"])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as e:
+            logging.warning("Ignoring corrupted cache entry for %s: %s", key, e)
+            return None
+
+    def _write_disk(self, key, entry):
+        path = self._path(key)
+        # Write to a temporary file first, so that readers never see a partial entry.
+        # Threads of several processes can write the same entry.
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump({"value": entry.value, "etag": entry.etag, "timestamp": entry.timestamp}, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+from numcodecs import blosc, Blosc
+
+SHUFFLE_MODES = {
+    "none": Blosc.NOSHUFFLE,
+    "byte": Blosc.SHUFFLE,
+    "bit": Blosc.BITSHUFFLE,
+    "auto": Blosc.AUTOSHUFFLE
+}
+
+# Codecs compared by trial_compressors when no candidates are given, as (compression, level, shuffle)
+DEFAULT_CANDIDATES = [
+    ("zstd", 3, "byte"),
+    ("zstd", 3, "bit"),
+    ("zstd", 9, "bit"),
+    ("lz4", 5, "byte"),
+    ("zlib", 5, "byte")
+]
+
+
+def make_compressor(compression="zstd", level=3, shuffle="byte"):
+    """
+    Creates a Blosc compressor for zarr chunks, or None for uncompressed chunks.
+
+    Parameters
+    ----------
+    compression - Blosc codec name (zstd, lz4, lz4hc, zlib, blosclz) or "none"
+    level - Compression level 0-9
+    shuffle - Shuffle filter applied before compression: none, byte, bit or auto
+    """
+    if compression is None or compression == "none":
+        return None
+    if compression not in blosc.list_compressors():
+        raise ValueError("Compression must be one of: " + ", ".join(blosc.list_compressors() + ["none"]))
+    if shuffle not in SHUFFLE_MODES:
+        raise ValueError("Shuffle must be one of: " + ", ".join(SHUFFLE_MODES))
+    return Blosc(cname=compression, clevel=level, shuffle=SHUFFLE_MODES[shuffle])
+
+
+def init_blosc_threads(threads):
+    """
+    Process initializer which makes Blosc compress every chunk with the given number of internal threads.
+    Only used in worker processes: in a multi-threaded process Blosc serializes all threaded compressions
+    on one global lock.
+    """
+    blosc.use_threads = True
+    blosc.set_nthreads(threads)
+
+
+def trial_compressors(tiles, candidates=None):
+    """
+    Compresses sample tiles with each candidate codec and measures encode speed and compression ratio.
+
+    Parameters
+    ----------
+    tiles - List of numpy arrays
+    candidates - List of (compression, level, shuffle) tuples, by default DEFAULT_CANDIDATES
+
+    Returns
+    -------
+    List of dicts with compression, level, shuffle, ratio and encode_mb_s, sorted by ratio
+    """
+    if candidates is None:
+        candidates = DEFAULT_CANDIDATES
+
+    raw_bytes = sum(tile.nbytes for tile in tiles)
+    results = []
+    for compression, level, shuffle in candidates:
+        compressor = make_compressor(compression, level, shuffle)
+        compressed_bytes = 0
+        start = time.perf_counter()
+        for tile in tiles:
+            tile = np.ascontiguousarray(tile)
+            compressed_bytes += len(compressor.encode(tile)) if compressor is not None else tile.nbytes
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        results.append({
+            "compression": compression,
+            "level": level,
+            "shuffle": shuffle,
+            "ratio": raw_bytes / max(compressed_bytes, 1),
+            "encode_mb_s": raw_bytes / elapsed / 1e6
+        })
+
+    return sorted(results, key=lambda result: result["ratio"], reverse=True)
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+
+import botocore.exceptions
+
+# S3 error codes which mean requests are sent too fast
+THROTTLE_CODES = frozenset(["SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                            "TooManyRequestsException", "503"])
+
+
+def is_throttle(error):
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get("Error", {}).get("Code") in THROTTLE_CODES
+    return False
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the number of concurrent transfers and tunes the limit with additive increase and
+    multiplicative decrease (AIMD). The limit is evaluated after each window of completed transfers:
+    it is halved when transfers were throttled or failed, raised by one while throughput keeps improving
+    and lowered by one when more concurrency made throughput worse.
+
+    Thread-safe, one instance can be shared by importer, exporter and uploader so that they
+    adapt to the same network. Thread pools are sized to maximum and the limit decides how many
+    of their threads transfer at the same time.
+    """
+
+    def __init__(self, initial=10, minimum=2, maximum=64, decrease=0.5, min_interval=1.0):
+        """
+        Parameters
+        ----------
+        initial - Initial number of concurrent transfers
+        minimum - Lower bound of the limit
+        maximum - Upper bound of the limit
+        decrease - Factor applied to the limit on throttling or errors
+        min_interval - Minimum seconds between adjustments, so throughput is measured over enough transfers
+        """
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("Concurrency limits must satisfy 1 <= minimum <= initial <= maximum")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.min_interval = min_interval
+        self._limit = initial
+        self._active = 0
+        self._condition = threading.Condition()
+        self._window_start = time.perf_counter()
+        self._window_completed = 0
+        self._window_errors = 0
+        self._last_throughput = None
+        self.completed = 0
+        self.errors = 0
+        self.throttled = 0
+
+    @classmethod
+    def fixed(cls, concurrency):
+        """
+        Controller which always allows exactly the given number of concurrent transfers
+        """
+        return cls(concurrency, concurrency, concurrency)
+
+    @property
+    def limit(self):
+        """
+        Current number of concurrent transfers allowed
+        """
+        return self._limit
+
+    @property
+    def active(self):
+        return self._active
+
+    def acquire(self):
+        with self._condition:
+            while self._active >= self._limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, error=None):
+        """
+        Ends a transfer started with acquire.
+
+        Parameters
+        ----------
+        error - Exception which made the transfer fail, None if it succeeded
+        """
+        with self._condition:
+            self._active -= 1
+            self.completed += 1
+            self._window_completed += 1
+            if error is not None:
+                self.errors += 1
+                self._window_errors += 1
+                if is_throttle(error):
+                    self.throttled += 1
+            self._adjust()
+            self._condition.notify_all()
+
+    def call(self, function, *args, **kwargs):
+        """
+        Runs function as one transfer counted against the limit.
+        """
+        self.acquire()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self.release(e)
+            raise
+        self.release()
+        return result
+
+    def _adjust(self):
+        elapsed = time.perf_counter() - self._window_start
+        if self._window_completed < self._limit or elapsed < self.min_interval:
+            return
+
+        throughput = self._window_completed / elapsed
+        limit = self._limit
+        if self._window_errors:
+            limit = max(self.minimum, int(limit * self.decrease))
+            # Throughput measured with errors does not describe the new limit
+            throughput = None
+        elif self._last_throughput is None or throughput >= self._last_throughput:
+            limit = min(self.maximum, limit + 1)
+        else:
+            limit = max(self.minimum, limit - 1)
+
+        if limit != self._limit:
+            logging.debug("Concurrency %s -> %s, %s transfers/s, %s errors", self._limit, limit,
+                          round(self._window_completed / elapsed, 1), self._window_errors)
+        self._limit = limit
+        self._last_throughput = throughput
+        self._window_start = time.perf_counter()
+        self._window_completed = 0
+        self._window_errors = 0
+
+    def summary(self):
+        with self._condition:
+            return {
+                "limit": self._limit,
+                "active": self._active,
+                "completed": self.completed,
+                "errors": self.errors,
+                "throttled": self.throttled
+            }
@@ -35,6 +35,25 @@ class FileUtils:
         logging.info(files)
         return files
 
+    @staticmethod
+    def scan_files_regex(dir, pattern):
+        """
+        Lists the files in dir which match pattern, like list_files_regex. Uses os.scandir, which
+        does not need a stat call per file, and does not log every file, for directories of many tiles.
+        """
+        files = []
+        skipped = 0
+        prog = re.compile(pattern)
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if prog.match(entry.name) and entry.is_file():
+                    files.append(entry.path)
+                else:
+                    skipped += 1
+
+        logging.info("Found %s files in %s, skipped %s files not matching tile pattern", len(files), dir, skipped)
+        return sorted(files)
+
     @staticmethod
     def validate_name(s, object_type=None):
         if len(s) > FileUtils._length_name or FileUtils._valid_name.match(s) is None:
@@ -78,6 +97,31 @@ class FileUtils:
         xml_str = ElementTree.tostring(xml_root, encoding='utf-8')
         return xml_str
 
+    @staticmethod
+    def subset_xml(metadata, channels, width, height, scale=1):
+        '''
+        Describe a subset of an image: keep only the given channels, set the plane size
+        and scale the physical pixel size by the downsampling factor.
+        '''
+        ElementTree.register_namespace('', OME_NS)
+        xml_root = ElementTree.fromstring(metadata)
+        ns = {'ome': OME_NS}
+        for pixels in xml_root.iterfind('ome:Image/ome:Pixels', ns):
+            pixels.attrib['SizeX'] = str(width)
+            pixels.attrib['SizeY'] = str(height)
+            pixels.attrib['SizeC'] = str(len(channels))
+            for attribute in ('PhysicalSizeX', 'PhysicalSizeY'):
+                if attribute in pixels.attrib:
+                    pixels.attrib[attribute] = str(float(pixels.attrib[attribute]) * scale)
+            for i, channel in enumerate(list(pixels.iterfind('ome:Channel', ns))):
+                if i not in channels:
+                    pixels.remove(channel)
+            # TiffData and Plane refer to the planes of the original file
+            for elt in list(pixels.iterfind('ome:TiffData', ns)) + list(pixels.iterfind('ome:Plane', ns)):
+                pixels.remove(elt)
+
+        return ElementTree.tostring(xml_root, encoding='utf-8')
+
     @staticmethod
     def get_pyramid_levels(filenames):
         max_level = 0
@@ -95,19 +139,26 @@ class FileUtils:
         Validate that files are of supported tile format: 16-bit grayscale png
         '''
         for tile in files:
-            with open(tile, 'rb') as f:
-                # png signature
-                signature = f.read(8)
-                png = signature[1:4]
-                if png != b'PNG':
-                    raise ValueError('Invalid file ' + tile + '. Image must be a PNG image!')
-                # signature end
-
-                #  IHDR chunk
-                ihdr = f.read(25)
-                depth = ihdr[16]
-                color = ihdr[17]
-                if depth != 16:
-                    raise ValueError('Invalid file ' + tile + '. PNG must be 16 bit depth! Depth: ', depth)
-                if color != 0:
-                    raise ValueError('Invalid file ' + tile + '. PNG must be grayscale! Color: ', color)
\ No newline at end of file
+            FileUtils.validate_tile(tile)
+
+    @staticmethod
+    def validate_tile(tile):
+        '''
+        Validate that a file is of supported tile format: 16-bit grayscale png
+        '''
+        with open(tile, 'rb') as f:
+            # png signature
+            signature = f.read(8)
+            png = signature[1:4]
+            if png != b'PNG':
+                raise ValueError('Invalid file ' + tile + '. Image must be a PNG image!')
+            # signature end
+
+            #  IHDR chunk
+            ihdr = f.read(25)
+            depth = ihdr[16]
+            color = ihdr[17]
+            if depth != 16:
+                raise ValueError('Invalid file ' + tile + '. PNG must be 16 bit depth! Depth: ', depth)
+            if color != 0:
+                raise ValueError('Invalid file ' + tile + '. PNG must be grayscale! Color: ', color)
\ No newline at end of file
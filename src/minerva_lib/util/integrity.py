@@ -0,0 +1,223 @@
+import base64
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+from collections.abc import MutableMapping
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+BLOCK_SIZE = 8 * 1024 * 1024
+# Part size used by s3transfer unless configured otherwise
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+CHECKSUM_ALGORITHMS = ("md5", "crc32c")
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class TransferFailed(Exception):
+    def __init__(self, report):
+        super().__init__("{} transfers failed: {}".format(len(report.failed), ", ".join(sorted(report.failed))))
+        self.report = report
+
+
+def check_algorithm(algorithm):
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError("Checksum algorithm must be one of: " + ", ".join(CHECKSUM_ALGORITHMS))
+    if algorithm == "crc32c" and crc32c is None:
+        raise ImportError("crc32c checksums require the crc32c package (pip install crc32c)")
+
+
+def _blocks(data, block_size):
+    """
+    Yields blocks of a bytes-like object or of the file at the given path.
+    """
+    if isinstance(data, str):
+        with open(data, "rb") as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    return
+                yield block
+    else:
+        view = memoryview(data).cast("B")
+        for i in range(0, max(len(view), 1), block_size):
+            yield view[i:i + block_size]
+
+
+def _size(data):
+    return os.path.getsize(data) if isinstance(data, str) else memoryview(data).nbytes
+
+
+def md5_etag(data, part_size=None):
+    """
+    ETag S3 computes for data: the MD5 for single part uploads, or the MD5 of the
+    concatenated part MD5s followed by the part count for multipart uploads.
+    """
+    if part_size is None:
+        md5 = hashlib.md5()
+        for block in _blocks(data, BLOCK_SIZE):
+            md5.update(block)
+        return md5.hexdigest()
+
+    digests = [hashlib.md5(block).digest() for block in _blocks(data, part_size)]
+    return "{}-{}".format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+
+def etag_matches(etag, data, part_size=DEFAULT_PART_SIZE):
+    """
+    Returns True or False, or None if the ETag is not an MD5 based ETag that can be reproduced.
+    """
+    etag = etag.strip('"')
+    if "-" not in etag:
+        if len(etag) != 32:
+            # e.g. objects encrypted with SSE-KMS
+            return None
+        return md5_etag(data) == etag
+
+    # Multipart ETag, try the configured part size and the smallest part size (MiB aligned) giving that part count
+    parts = int(etag.split("-")[1])
+    mib = 1024 * 1024
+    candidates = [part_size, math.ceil(_size(data) / parts / mib) * mib]
+    candidates = [candidate for candidate in candidates
+                  if candidate > 0 and math.ceil(_size(data) / candidate) == parts]
+    if not candidates:
+        # The part size cannot be determined
+        return None
+    return any(md5_etag(data, candidate) == etag for candidate in candidates)
+
+
+def crc32c_checksum(data):
+    """
+    Base64 encoded big-endian CRC32C, the format S3 reports in ChecksumCRC32C.
+    """
+    value = 0
+    for block in _blocks(data, BLOCK_SIZE):
+        value = crc32c.crc32c(block, value)
+    return base64.b64encode(struct.pack(">I", value)).decode("ascii")
+
+
+def verify_object(s3, bucket, key, data, etag=None, algorithm="md5", part_size=DEFAULT_PART_SIZE):
+    """
+    Compares data (bytes or a file path) with the object in S3.
+    Returns True or False, or None if the object has no comparable checksum.
+    """
+    if algorithm == "crc32c":
+        head = s3.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED")
+        if "ChecksumCRC32C" in head and "-" not in head["ChecksumCRC32C"]:
+            return crc32c_checksum(data) == head["ChecksumCRC32C"]
+        etag = head["ETag"]
+
+    if etag is None:
+        etag = s3.head_object(Bucket=bucket, Key=key)["ETag"]
+    return etag_matches(etag, data, part_size)
+
+
+class TransferReport:
+    """
+    Thread-safe summary of transferred, verified, retried and failed objects.
+    """
+
+    def __init__(self):
+        self.transferred = 0
+        self.bytes = 0
+        self.verified = 0
+        self.unverified = 0
+        self.retried = {}
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def add_success(self, key, size=0, verified=False):
+        """
+        Parameters
+        ----------
+        verified - True if the checksum matched, None if there was no checksum to compare with,
+                   False if verification was not requested
+        """
+        with self._lock:
+            self.transferred += 1
+            self.bytes += size
+            if verified:
+                self.verified += 1
+            elif verified is None:
+                self.unverified += 1
+            self.failed.pop(key, None)
+
+    def add_retry(self, key, reason):
+        logging.warning("Retrying %s: %s", key, reason)
+        with self._lock:
+            self.retried[key] = self.retried.get(key, 0) + 1
+
+    def add_failure(self, key, error):
+        logging.error("Transfer of %s failed: %s", key, error)
+        with self._lock:
+            self.failed[key] = str(error)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "transferred": self.transferred,
+                "bytes": self.bytes,
+                "verified": self.verified,
+                "unverified": self.unverified,
+                "retried": len(self.retried),
+                "failed": len(self.failed)
+            }
+
+    def log_summary(self, logger=logging):
+        logger.info("Transfer summary: %s", self.summary())
+        for key, error in sorted(self.failed.items()):
+            logger.error("Failed: %s (%s)", key, error)
+
+    def raise_for_failures(self):
+        if len(self.failed) > 0:
+            raise TransferFailed(self)
+
+
+class VerifiedStore(MutableMapping):
+    """
+    Zarr store wrapper which compares every written value with the object S3 stored for it.
+    Mismatches and write errors are recorded in the report and raised.
+    """
+
+    def __init__(self, store, s3, bucket, prefix, report, algorithm="md5"):
+        self.store = store
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.report = report
+        self.algorithm = algorithm
+
+    def __getitem__(self, key):
+        return self.store[key]
+
+    def __setitem__(self, key, value):
+        s3_key = self.prefix + "/" + key
+        try:
+            self.store[key] = value
+            verified = verify_object(self.s3, self.bucket, s3_key, value, algorithm=self.algorithm)
+            if verified is False:
+                raise ChecksumMismatch(s3_key)
+        except Exception as e:
+            self.report.add_failure(s3_key, e)
+            raise
+        self.report.add_success(s3_key, _size(value), verified)
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
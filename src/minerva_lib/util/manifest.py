@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import threading
+
+
+class TransferManifest:
+    """
+    Append-only JSON lines file recording completed transfers, so that an interrupted
+    transfer can be resumed by skipping the objects which were already transferred.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        truncated = False
+        if os.path.exists(path):
+            truncated = self._load()
+        self._file = open(path, "a")
+        if truncated:
+            # Terminate the partial last line, so the next entry starts on a line of its own
+            self._file.write("\n")
+
+    def _load(self):
+        """
+        Returns True if the file does not end with a newline.
+        """
+        line = ""
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be partial if the process was killed while writing
+                    logging.warning("Skipping invalid manifest line in %s", self.path)
+                    continue
+                self.entries[entry["key"]] = entry
+        return line != "" and not line.endswith("\n")
+
+    def is_complete(self, key, size=None, etag=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if size is not None and entry.get("size") != size:
+            return False
+        if etag is not None and entry.get("etag") != etag:
+            return False
+        return True
+
+    def add(self, key, **attributes):
+        entry = dict(key=key, **attributes)
+        with self._lock:
+            self.entries[key] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,4 +1,4 @@
-import os, sys, threading
+import os, sys, threading, time
 
 class ProgressPercentage:
 
@@ -19,4 +19,68 @@ class ProgressPercentage:
                 "\r%s MB / %s MB (%.1f%%)" % (
                     self._seen_so_far // 1000000, self._total_size // 1000000,
                     percentage))
-            sys.stdout.flush()
\ No newline at end of file
+            sys.stdout.flush()
+
+class TransferMetrics:
+    """
+    Queue depth, bytes in flight and throughput of a pipeline of pending transfers.
+    Updates are also applied to the parent metrics, which aggregate several pipelines.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.queue_depth = 0
+        self.in_flight_bytes = 0
+        self.peak_queue_depth = 0
+        self.peak_in_flight_bytes = 0
+        self.completed = 0
+        self.completed_bytes = 0
+        self.skipped = 0
+
+    def submit(self, nbytes):
+        with self._lock:
+            self.queue_depth += 1
+            self.in_flight_bytes += nbytes
+            self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+            self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+        if self.parent is not None:
+            self.parent.submit(nbytes)
+
+    def complete(self, nbytes):
+        with self._lock:
+            self.queue_depth -= 1
+            self.in_flight_bytes -= nbytes
+            self.completed += 1
+            self.completed_bytes += nbytes
+        if self.parent is not None:
+            self.parent.complete(nbytes)
+
+    def skip(self):
+        """
+        Records an item which did not need to be transferred
+        """
+        with self._lock:
+            self.skipped += 1
+        if self.parent is not None:
+            self.parent.skip()
+
+    def throughput(self):
+        """
+        Completed bytes per second since the metrics were created
+        """
+        return self.completed_bytes / max(time.perf_counter() - self._start, 1e-9)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "in_flight_bytes": self.in_flight_bytes,
+                "peak_queue_depth": self.peak_queue_depth,
+                "peak_in_flight_bytes": self.peak_in_flight_bytes,
+                "completed": self.completed,
+                "completed_bytes": self.completed_bytes,
+                "skipped": self.skipped,
+                "throughput_mb_s": self.throughput() / 1e6
+            }
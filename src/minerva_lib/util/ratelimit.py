@@ -0,0 +1,109 @@
+import threading
+import time
+from collections.abc import MutableMapping
+
+DIRECTIONS = ("upload", "download")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket which limits a byte rate. Callers reserve their bytes in arrival order and
+    sleep outside the lock until the reservation is covered, so threads share the bandwidth fairly
+    and a large transfer cannot starve small ones.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Parameters
+        ----------
+        rate - Bytes per second
+        burst - Bytes which can be sent at once after an idle period, one second of rate if None
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """
+        Blocks until nbytes may be transferred.
+        """
+        if nbytes <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens may become negative, later callers then wait for this reservation as well
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Process-wide limiters shared by all uploads and downloads, disabled if None
+_limiters = {direction: None for direction in DIRECTIONS}
+
+
+def set_bandwidth_limit(upload=None, download=None, burst_seconds=1.0):
+    """
+    Limits the bandwidth of all uploads and downloads of this process, across all worker threads,
+    importers, exporters and uploaders.
+
+    Parameters
+    ----------
+    upload - Upload limit in MB/s, unlimited if None
+    download - Download limit in MB/s, unlimited if None
+    burst_seconds - How many seconds of bandwidth can be used at once after an idle period
+    """
+    for direction, rate in zip(DIRECTIONS, (upload, download)):
+        if rate is None:
+            _limiters[direction] = None
+        else:
+            _limiters[direction] = TokenBucket(rate * 1e6, rate * 1e6 * burst_seconds)
+
+
+def get_limiter(direction):
+    return _limiters[direction]
+
+
+def consume(direction, nbytes):
+    """
+    Blocks until nbytes may be transferred in the given direction, upload or download.
+    """
+    limiter = _limiters[direction]
+    if limiter is not None:
+        limiter.consume(nbytes)
+
+
+class RateLimitedStore(MutableMapping):
+    """
+    Zarr store wrapper which applies the process-wide bandwidth limits to reading and writing chunks.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, key):
+        value = self.store[key]
+        consume("download", len(value))
+        return value
+
+    def __setitem__(self, key, value):
+        consume("upload", memoryview(value).nbytes)
+        self.store[key] = value
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
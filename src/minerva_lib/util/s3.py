@@ -1,53 +1,341 @@
 from .progress import ProgressPercentage
+from .integrity import TransferReport, ChecksumMismatch, check_algorithm, verify_object
+from .concurrency import AdaptiveConcurrency
+from . import ratelimit
 import boto3
+import botocore.config
+import botocore.exceptions
 import logging
 import s3transfer
 import s3transfer.manager
 import s3transfer.subscribers
 import concurrent.futures
+import functools
+import io
+import os
+import threading
+from collections import OrderedDict
 
-class S3Uploader:
-    def __init__(self, region):
+
+def _credentials_key(credentials):
+    return credentials["AccessKeyId"], credentials["SecretAccessKey"], credentials["SessionToken"]
+
+
+class S3ClientPool:
+    """
+    Thread-safe cache of S3 clients keyed by credential set. Clients are thread-safe and keep
+    their HTTP connections alive, so reusing them avoids botocore setup and TLS handshakes per object.
+    """
+
+    def __init__(self, region, max_pool_connections=10, max_clients=16):
+        """
+        Parameters
+        ----------
+        region - AWS region
+        max_pool_connections - Maximum number of HTTP connections kept open per client
+        max_clients - Maximum number of cached clients, least recently used are discarded first
+        """
         self.region = region
-        self.transfer_config = s3transfer.manager.TransferConfig()
-        self.transfer_manager = None
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+        self.max_pool_connections = max_pool_connections
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
 
-    def upload_file(self, filepath, bucket, object_name, credentials, callback: ProgressPercentage=None):
+    def get(self, credentials):
+        key = _credentials_key(credentials)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+
+            # boto3's default session is not thread-safe, create clients from a dedicated session
+            session = boto3.session.Session(aws_access_key_id=credentials["AccessKeyId"],
+                                            aws_secret_access_key=credentials["SecretAccessKey"],
+                                            aws_session_token=credentials["SessionToken"],
+                                            region_name=self.region)
+            config = botocore.config.Config(max_pool_connections=self.max_pool_connections)
+            client = session.client("s3", config=config)
+            self._clients[key] = client
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+            return client
+
+
+class S3Destination:
+    """
+    S3 prefix as an export target. Objects are copied server-side when the destination
+    credentials can read the source bucket, otherwise they are streamed through memory.
+    """
+
+    def __init__(self, bucket, prefix="", credentials=None, region=None, client_pool=None):
+        """
+        Parameters
+        ----------
+        bucket - Destination bucket
+        prefix - Destination key prefix, the image's keys are copied under it
+        credentials - Destination credentials (AccessKeyId, SecretAccessKey, SessionToken), default credential chain if None
+        region - AWS region of the destination bucket
+        client_pool - S3ClientPool for creating the destination client
+        """
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        if credentials is not None:
+            pool = client_pool if client_pool is not None else S3ClientPool(region)
+            self.client = pool.get(credentials)
+        else:
+            self.client = boto3.session.Session(region_name=region).client("s3")
+        self._server_side_copy = True
+
+    def get_key(self, key):
+        return self.prefix + "/" + key if self.prefix else key
+
+    def copy(self, source_client, source_bucket, source_key, key):
+        destination_key = self.get_key(key)
+        if self._server_side_copy:
+            try:
+                self.client.copy_object(CopySource={"Bucket": source_bucket, "Key": source_key},
+                                        Bucket=self.bucket, Key=destination_key)
+                return
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] not in ("AccessDenied", "403"):
+                    raise
+                logging.info("Server-side copy is not permitted, streaming objects instead")
+                self._server_side_copy = False
+
+        body = source_client.get_object(Bucket=source_bucket, Key=source_key)["Body"]
+        self.client.upload_fileobj(body, self.bucket, destination_key,
+                                   Callback=functools.partial(ratelimit.consume, "upload"))
+
+
+class ProgressSubscriber(s3transfer.subscribers.BaseSubscriber):
+    """
+    Forwards s3transfer progress events to a callback taking the number of bytes transferred,
+    e.g. ProgressPercentage.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        self._callback(bytes_transferred)
+
+
+class RateLimitSubscriber(s3transfer.subscribers.BaseSubscriber):
+    """
+    Applies the process-wide upload bandwidth limit. Progress is reported while the request body
+    is read, so blocking here slows down the transfer thread which sends the data.
+    """
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        ratelimit.consume("upload", bytes_transferred)
+
+
+class ReportSubscriber(s3transfer.subscribers.BaseSubscriber):
+    """
+    Records the outcome of an upload in a TransferReport and releases its AdaptiveConcurrency slot.
+    If a checksum algorithm is given, the stored object is compared with the uploaded data in the transfer thread.
+
+    s3transfer releases callers waiting on its future before it runs the subscribers, so callers
+    wait on this subscriber's future instead. It completes once the outcome has been recorded and
+    raises if the upload or its verification failed.
+    """
+
+    def __init__(self, report, s3, bucket, key, data, size, algorithm=None, part_size=None, concurrency=None):
+        self._report = report
+        self._concurrency = concurrency
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+        self._data = data
+        self._size = size
+        self._algorithm = algorithm
+        self._part_size = part_size
+        self.future = concurrent.futures.Future()
+
+    def on_done(self, future, **kwargs):
         try:
-            logging.info("Uploading file %s", filepath)
-            s3 = boto3.client("s3", aws_access_key_id=credentials["AccessKeyId"],
-                              aws_secret_access_key=credentials["SecretAccessKey"],
-                              aws_session_token=credentials["SessionToken"],
-                              region_name=self.region)
+            self._record(future)
+        except Exception as e:
+            self.future.set_exception(e)
+            return
+        self.future.set_result(None)
 
-            s3.upload_file(filepath, bucket, object_name, Callback=callback)
+    def _record(self, future):
+        verified = False
+        try:
+            try:
+                future.result()
+            except Exception as e:
+                self._release(e)
+                raise
+            # The slot covers the transfer only, verification is a separate request
+            self._release()
+            if self._algorithm is not None:
+                verified = verify_object(self._s3, self._bucket, self._key, self._data, algorithm=self._algorithm,
+                                         part_size=self._part_size)
+                if verified is False:
+                    raise ChecksumMismatch(self._key)
         except Exception as e:
-            logging.error(e)
+            self._report.add_failure(self._key, e)
+            raise
+        self._report.add_success(self._key, self._size, verified)
 
-    def upload_data(self, data, bucket, object_name, credentials):
+    def _release(self, error=None):
+        if self._concurrency is not None:
+            self._concurrency.release(error)
+
+
+class S3Uploader:
+    def __init__(self, region, max_pool_connections=10, client_pool=None, multipart_chunksize=8 * 1024 * 1024,
+                 max_concurrency=10, max_bandwidth=None, verify=None, concurrency: AdaptiveConcurrency=None):
+        """
+        Parameters
+        ----------
+        region - AWS region
+        max_pool_connections - Maximum number of HTTP connections per S3 client
+        client_pool - S3ClientPool to share clients with other components, created if None
+        multipart_chunksize - Part size in bytes, files larger than this are uploaded in parts
+        max_concurrency - Maximum number of concurrent requests (parts or objects)
+        max_bandwidth - Maximum upload bandwidth in bytes per second of each transfer manager, unlimited if None.
+            See ratelimit.set_bandwidth_limit for a limit shared by all uploads of the process.
+        verify - Checksum algorithm (md5 or crc32c) for verifying every uploaded object, disabled if None
+        concurrency - AdaptiveConcurrency which limits the number of objects being uploaded at the same time,
+            overrides max_concurrency. Uploads wait for a free slot when the limit is reached.
+        """
+        if verify is not None:
+            check_algorithm(verify)
+        if concurrency is not None:
+            max_concurrency = concurrency.maximum
+        self.concurrency = concurrency
+        self.region = region
+        self.verify = verify
+        self.report = TransferReport()
+        self.client_pool = client_pool if client_pool is not None else \
+            S3ClientPool(region, max(max_pool_connections, max_concurrency))
+        self.transfer_config = s3transfer.manager.TransferConfig(multipart_threshold=multipart_chunksize,
+                                                                 multipart_chunksize=multipart_chunksize,
+                                                                 max_request_concurrency=max_concurrency,
+                                                                 max_bandwidth=max_bandwidth)
+        self._transfer_managers = OrderedDict()
+        # Uploads in progress per manager, evicted managers are retired until they have none
+        self._manager_users = {}
+        self._retired_managers = []
+        self._lock = threading.Lock()
+
+    def reset_report(self):
+        """
+        Starts a new report, so each import only reports its own transfers.
+        """
+        self.report = TransferReport()
+        return self.report
+
+    def _get_transfer_manager(self, credentials):
+        """
+        Returns the TransferManager of a credential set and counts the caller as one of its users,
+        _release_transfer_manager must be called once the upload is done.
+        """
+        # A TransferManager is bound to one client, so there is one per credential set
+        # sharing the same transfer configuration. Like clients, least recently used managers are discarded.
+        key = _credentials_key(credentials)
+        with self._lock:
+            manager = self._transfer_managers.get(key)
+            if manager is not None:
+                self._transfer_managers.move_to_end(key)
+            else:
+                s3 = self.client_pool.get(credentials)
+                manager = s3transfer.manager.TransferManager(s3, config=self.transfer_config)
+                self._transfer_managers[key] = manager
+                if len(self._transfer_managers) > self.client_pool.max_clients:
+                    # Other threads may still be uploading with the evicted manager, it is shut down once idle
+                    self._retired_managers.append(self._transfer_managers.popitem(last=False)[1])
+            self._manager_users[manager] = self._manager_users.get(manager, 0) + 1
+            idle = [retired for retired in self._retired_managers if retired not in self._manager_users]
+            self._retired_managers = [retired for retired in self._retired_managers if retired in self._manager_users]
+        for retired in idle:
+            retired.shutdown()
+        return manager
+
+    def _release_transfer_manager(self, manager):
+        with self._lock:
+            self._manager_users[manager] -= 1
+            if self._manager_users[manager] == 0:
+                del self._manager_users[manager]
+
+    def upload_file_async(self, filepath, bucket, object_name, credentials, callback: ProgressPercentage=None):
+        """
+        Returns a future which completes after the upload has been recorded in the report,
+        result() raises if the upload failed.
+        """
+        logging.debug("Uploading file %s", filepath)
+        return self._upload(credentials, filepath, bucket, object_name, filepath, os.path.getsize(filepath), callback)
+
+    def upload_data_async(self, data, bucket, object_name, credentials, callback=None):
+        """
+        Returns a future which completes after the upload has been recorded in the report,
+        result() raises if the upload failed.
+        """
+        logging.debug("Uploading object %s", object_name)
+        if isinstance(data, io.BytesIO):
+            data = data.getvalue()
+        return self._upload(credentials, io.BytesIO(data), bucket, object_name, data, len(data), callback)
+
+    def _upload(self, credentials, fileobj, bucket, object_name, data, size, callback):
+        manager = self._get_transfer_manager(credentials)
         try:
-            logging.info("Uploading object %s", object_name)
-            s3 = boto3.client("s3", aws_access_key_id=credentials["AccessKeyId"],
-                              aws_secret_access_key=credentials["SecretAccessKey"],
-                              aws_session_token=credentials["SessionToken"],
-                              region_name=self.region)
-            s3.put_object(Body=data, Bucket=bucket, Key=object_name)
+            future = self._submit(manager, fileobj, bucket, object_name, credentials, data, size, callback)
+        except Exception:
+            self._release_transfer_manager(manager)
+            raise
+        future.add_done_callback(lambda _: self._release_transfer_manager(manager))
+        return future
+
+    def _submit(self, manager, fileobj, bucket, object_name, credentials, data, size, callback):
+        report = ReportSubscriber(self.report, self.client_pool.get(credentials), bucket, object_name, data, size,
+                                  self.verify, self.transfer_config.multipart_chunksize, self.concurrency)
+        subscribers = [report, RateLimitSubscriber()]
+        if callback is not None:
+            subscribers.append(ProgressSubscriber(callback))
+        if self.concurrency is None:
+            manager.upload(fileobj, bucket, object_name, subscribers=subscribers)
+            return report.future
 
+        self.concurrency.acquire()
+        try:
+            manager.upload(fileobj, bucket, object_name, subscribers=subscribers)
         except Exception as e:
-            logging.error(e)
+            self.concurrency.release(e)
+            raise
+        return report.future
 
-    def async_upload(self, buf, bucket, object_name, credentials, tile_content_type="image/tiff"):
-        if self.transfer_manager is None:
-            s3 = boto3.client("s3", aws_access_key_id=credentials["AccessKeyId"],
-                              aws_secret_access_key=credentials["SecretAccessKey"],
-                              aws_session_token=credentials["SessionToken"],
-                              region_name=self.region)
+    def upload_file(self, filepath, bucket, object_name, credentials, callback: ProgressPercentage=None):
+        """
+        Uploads a file and waits for completion. Errors are recorded in the report instead of raised.
+        """
+        try:
+            self.upload_file_async(filepath, bucket, object_name, credentials, callback).result()
+        except Exception as e:
+            logging.debug(e)
 
-            self.transfer_manager = s3transfer.manager.TransferManager(s3, config=self.transfer_config)
+    def upload_data(self, data, bucket, object_name, credentials):
+        """
+        Uploads data and waits for completion. Errors are recorded in the report instead of raised.
+        """
+        try:
+            self.upload_data_async(data, bucket, object_name, credentials).result()
+        except Exception as e:
+            logging.debug(e)
 
-        future = self.executor.submit(self.upload_data, buf, bucket, object_name, credentials)
-        return future
+    def async_upload(self, buf, bucket, object_name, credentials, tile_content_type="image/tiff"):
+        return self.upload_data_async(buf, bucket, object_name, credentials)
 
     def wait_upload(self):
-        self.executor.shutdown()
\ No newline at end of file
+        """
+        Waits until all pending uploads have completed. The uploader can be used again afterwards.
+        """
+        with self._lock:
+            managers = list(self._transfer_managers.values()) + self._retired_managers
+            self._transfer_managers.clear()
+            self._retired_managers = []
+        for manager in managers:
+            manager.shutdown()
@@ -0,0 +1,149 @@
+import requests
+from minerva_lib.client import MinervaClient
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ""
+
+    def json(self):
+        return {"status": self.status_code}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+class FakeSession:
+    def __init__(self, status_codes):
+        self.status_codes = list(status_codes)
+        self.calls = []
+        self.timeouts = []
+
+    def request(self, method, url, data=None, params=None, headers=None, timeout=None):
+        self.calls.append((method, url, headers))
+        self.timeouts.append(timeout)
+        status = self.status_codes.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        if isinstance(status, FakeResponse):
+            return status
+        return FakeResponse(status)
+
+
+def _client(status_codes, endpoint="https://minerva", **kwargs):
+    client = MinervaClient(endpoint, "us-east-1", "client_id", backoff_factor=0, **kwargs)
+    client._set_tokens({"IdToken": "token", "TokenType": "Bearer", "RefreshToken": "refresh"})
+    client.session = FakeSession(status_codes)
+    return client
+
+def test_retry_idempotent():
+    client = _client([503, 502, 200])
+    assert client.request("GET", "/image/1") == {"status": 200}
+    assert len(client.session.calls) == 3
+    assert client.session.calls[0][2] == {"Authorization": "Bearer token"}
+
+def test_retry_timeout():
+    client = _client([requests.exceptions.ReadTimeout("timed out"), 200], timeout=(1, 5))
+    assert client.request("GET", "/image/1") == {"status": 200}
+    assert client.session.timeouts == [(1, 5), (1, 5)]
+
+def test_no_retry_non_idempotent():
+    client = _client([503, 200])
+    try:
+        client.request("POST", "/image")
+        assert False
+    except requests.exceptions.HTTPError as e:
+        assert e.response.status_code == 503
+    assert len(client.session.calls) == 1
+
+def test_retry_throttled_non_idempotent():
+    client = _client([429, 200])
+    assert client.request("POST", "/image") == {"status": 200}
+
+def test_max_retries():
+    client = _client([500, 500, 500], max_retries=2)
+    try:
+        client.request("GET", "/image/1")
+        assert False
+    except requests.exceptions.HTTPError:
+        pass
+    assert len(client.session.calls) == 3
+
+def test_cached_request():
+    client = _client([200, 200], cache_ttl=300)
+    image = client.get_image("1")
+    assert image == {"status": 200}
+    # Callers get copies of the cached response
+    image["status"] = 0
+    assert client.get_image("1") == {"status": 200}
+    assert len(client.session.calls) == 1
+
+def test_no_cache_by_default():
+    client = _client([200, 200])
+    assert client.get_image("1") == {"status": 200}
+    assert client.get_image("1") == {"status": 200}
+    assert len(client.session.calls) == 2
+
+def test_cached_request_revalidate(tmp_path):
+    client = _client([FakeResponse(200, {"ETag": "abc"}), 304], cache_ttl=1, cache_dir=str(tmp_path), cache_revalidate=True)
+    assert client.get_image_dimensions("1") == {"status": 200}
+    entry = client.response_cache.get("https://minerva/image/1/dimensions")
+    entry.timestamp -= 10
+    assert client.get_image_dimensions("1") == {"status": 200}
+    assert client.session.calls[1][2]["If-None-Match"] == "abc"
+
+    # A new client picks the entry up from the on-disk tier
+    other = _client([], cache_ttl=300, cache_dir=str(tmp_path))
+    assert other.get_image_dimensions("1") == {"status": 200}
+
+    # A client of another deployment does not get its responses
+    staging = _client([FakeResponse(200)], cache_ttl=300, cache_dir=str(tmp_path), endpoint="https://staging")
+    staging.get_image_dimensions("1")
+    assert len(staging.session.calls) == 1
+
+class FakeCognito:
+    class exceptions:
+        class NotAuthorizedException(Exception):
+            pass
+
+    def __init__(self):
+        self.calls = 0
+
+    def initiate_auth(self, AuthFlow, AuthParameters, ClientId):
+        assert AuthFlow == "REFRESH_TOKEN_AUTH"
+        assert AuthParameters["REFRESH_TOKEN"] == "refresh"
+        self.calls += 1
+        return {"AuthenticationResult": {"IdToken": "new_token", "TokenType": "Bearer", "ExpiresIn": 3600}}
+
+def test_refresh_on_unauthorized():
+    client = _client([401, 200])
+    client._cognito = FakeCognito()
+    assert client.request("GET", "/image/1") == {"status": 200}
+    assert client._cognito.calls == 1
+    assert client.session.calls[1][2] == {"Authorization": "Bearer new_token"}
+    assert client.refresh_token == "refresh"
+
+def test_refresh_ahead_of_expiry():
+    client = _client([200])
+    client._cognito = FakeCognito()
+    client.token_expires = 0
+    client.request("GET", "/image/1")
+    assert client._cognito.calls == 1
+    assert client.session.calls[0][2] == {"Authorization": "Bearer new_token"}
+
+def test_refresh_skipped_if_already_refreshed():
+    client = _client([])
+    client._cognito = FakeCognito()
+    client.refresh(expired_token="old_token")
+    assert client._cognito.calls == 0
+
+def test_explicit_refresh():
+    # Without ExpiresIn the token never counts as expiring, an explicit refresh still renews it
+    client = _client([])
+    client._cognito = FakeCognito()
+    client.refresh()
+    assert client._cognito.calls == 1
+    assert client.id_token == "new_token"
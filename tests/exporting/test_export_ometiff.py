@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+import tifffile
+import zarr
+from minerva_lib.exporting import MinervaExporter
+
+
+class FakeMinervaClient:
+    def __init__(self, levels):
+        self.group = zarr.group()
+        for level, data in enumerate(levels):
+            self.group.array(str(level), data, chunks=(1, 1, 1, 256, 256))
+
+    def get_image_array(self, uuid, level=0):
+        return self.group[str(level)]
+
+    def get_raw_tile(self, uuid, x, y, z, t, c, level, tile_size=1024):
+        return self.group[str(level)][t, c, z, y:y + tile_size, x:x + tile_size]
+
+
+def _image(shape, levels, tile_size=256):
+    return {
+        "data": {"pixels": {"channels": [{}] * shape[1], "SizeX": shape[4], "SizeY": shape[3]}},
+        "included": {"images": [{"name": "test", "pyramid_levels": levels, "tile_size": tile_size}]}
+    }
+
+def _random(shape, dtype):
+    return np.random.randint(0, 1000, size=shape).astype(dtype)
+
+def test_export_ometiff(tmp_path):
+    data = _random((1, 2, 1, 600, 520), np.uint8)
+    client = FakeMinervaClient([data])
+    path = str(tmp_path / "test.ome.tif")
+    progress = []
+    exporter = MinervaExporter("us-east-1")
+    exporter.export_image_ometiff(_image(data.shape, 1), b"<OME/>", client, "img", path,
+                                  progress_callback=lambda a, b: progress.append((a, b)), prefetch=4)
+
+    with tifffile.TiffFile(path) as tif:
+        assert tif.pages[0].tile == (256, 256)
+        assert tif.pages[0].dtype == np.uint8
+        for channel in range(2):
+            assert np.array_equal(tif.pages[channel].asarray(), data[0, channel, 0])
+    assert progress[-1] == (18, 18)
+
+def test_export_ometiff_pyramid(tmp_path):
+    data = _random((1, 2, 1, 600, 520), np.uint16)
+    level1 = data[:, :, :, ::2, ::2]
+    client = FakeMinervaClient([data, level1])
+    path = str(tmp_path / "test.ome.tif")
+    exporter = MinervaExporter("us-east-1")
+    exporter.export_image_ometiff(_image(data.shape, 2), b"<OME/>", client, "img", path, save_pyramid=True,
+                                  prefetch=64)
+
+    with tifffile.TiffFile(path) as tif:
+        assert len(tif.pages) == 2
+        levels = tif.series[0].levels
+        assert len(levels) == 2
+        assert np.array_equal(levels[0].asarray()[1], data[0, 1, 0])
+        assert np.array_equal(levels[1].asarray()[1], level1[0, 1, 0])
+
+@pytest.mark.parametrize("compression,parallel", [("zstd", True), ("zlib", False), ("lzw", True), ("lzma", False)])
+def test_export_ometiff_compression(tmp_path, compression, parallel):
+    data = _random((1, 1, 1, 300, 300), np.uint16)
+    client = FakeMinervaClient([data])
+    path = str(tmp_path / "test.ome.tif")
+    exporter = MinervaExporter("us-east-1")
+    exporter.export_image_ometiff(_image(data.shape, 1), b"<OME/>", client, "img", path,
+                                  compression=compression, compression_level=None if compression == "lzw" else 5,
+                                  parallel_compression=parallel)
+
+    with tifffile.TiffFile(path) as tif:
+        assert tif.pages[0].compression != 1
+        assert np.array_equal(tif.pages[0].asarray(), data[0, 0, 0])
+
+def test_export_ometiff_unsupported_compression(tmp_path):
+    exporter = MinervaExporter("us-east-1")
+    with pytest.raises(ValueError):
+        exporter._get_tile_encoder("unknown")
+
+OME_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">
+<Image ID="Image:0"><Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="uint16" SizeX="520" SizeY="600" SizeC="3" SizeZ="1" SizeT="1" PhysicalSizeX="0.5" PhysicalSizeY="0.5">
+<Channel ID="Channel:0:0" Name="DAPI"/><Channel ID="Channel:0:1" Name="CD3"/><Channel ID="Channel:0:2" Name="CD8"/>
+<TiffData IFD="0" PlaneCount="3"/>
+</Pixels></Image></OME>"""
+
+def test_export_ometiff_selection(tmp_path):
+    data = _random((1, 3, 1, 600, 520), np.uint16)
+    level1 = data[:, :, :, ::2, ::2]
+    client = FakeMinervaClient([data, level1])
+    path = str(tmp_path / "test.ome.tif")
+    exporter = MinervaExporter("us-east-1")
+    image = _image(data.shape, 2)
+    exporter.export_image_ometiff(image, OME_XML, client, "img", path, region=(100, 50, 300, 400), channels=[0, 2], levels=[1])
+
+    with tifffile.TiffFile(path) as tif:
+        assert len(tif.pages) == 2
+        assert np.array_equal(tif.pages[1].asarray(), level1[0, 2, 0, 25:225, 50:200])
+        ome = tif.pages[0].description
+        assert 'SizeX="150"' in ome and 'SizeY="200"' in ome and 'SizeC="2"' in ome
+        assert "CD3" not in ome and 'PhysicalSizeX="1.0"' in ome
+
+def test_export_ometiff_region_pyramid(tmp_path):
+    data = _random((1, 3, 1, 600, 520), np.uint16)
+    pyramid = [data, data[:, :, :, ::2, ::2], data[:, :, :, ::4, ::4]]
+    client = FakeMinervaClient(pyramid)
+    path = str(tmp_path / "test.ome.tif")
+    exporter = MinervaExporter("us-east-1")
+    exporter.export_image_ometiff(_image(data.shape, 3), OME_XML, client, "img", path, region=(101, 51, 250, 301),
+                                  save_pyramid=True)
+
+    with tifffile.TiffFile(path) as tif:
+        levels = tif.series[0].levels
+        # Every level is read back, each one half the size of the level above
+        assert len(levels) == 3
+        assert [level.shape[-2:] for level in levels] == [(301, 250), (151, 125), (76, 63)]
+        assert np.array_equal(levels[0].asarray()[1], data[0, 1, 0, 51:352, 101:351])
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import time
+import pytest
+import zarr
+from minerva_lib.exporting import MinervaExporter, MANIFEST_FILENAME
+from minerva_lib.util.integrity import TransferFailed
+from minerva_lib.util.manifest import TransferManifest
+
+CREDENTIALS = {"AccessKeyId": "A", "SecretAccessKey": "B", "SessionToken": "C"}
+
+
+class FakeS3:
+    def __init__(self, objects, fail=()):
+        self.objects = objects
+        self.fail = set(fail)
+        self.downloads = []
+        self.listed = []
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix, PaginationConfig=None, Delimiter=None):
+        self.listed.append(Prefix)
+        keys = sorted(k for k in self.objects if k.startswith(Prefix)
+                      and (Delimiter is None or Delimiter not in k[len(Prefix):]))
+        contents = [{"Key": k, "Size": len(self.objects[k]), "ETag": '"%s"' % hash(self.objects[k])} for k in keys]
+        yield {"Contents": contents[:2]}
+        yield {"Contents": contents[2:]}
+
+    def download_file(self, Bucket, Key, Filename, Callback=None):
+        if Key in self.fail:
+            raise IOError("Download failed: " + Key)
+        self.downloads.append(Key)
+        with open(Filename, "wb") as f:
+            f.write(self.objects[Key])
+        if Callback is not None:
+            Callback(len(self.objects[Key]))
+
+
+class FakePool:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def get(self, credentials):
+        return self.s3
+
+
+class FakeMinervaClient:
+    def get_image_credentials(self, image_uuid):
+        return CREDENTIALS, "bucket", image_uuid
+
+
+OBJECTS = {
+    "img/.zgroup": b"{}",
+    "img/0/.zarray": b"{}",
+    "img/0/0.0.0.0.0": b"chunk0",
+    "img/0/0.1.0.0.0": b"chunk1",
+}
+
+def test_export_zarr_resume(tmp_path):
+    s3 = FakeS3(OBJECTS, fail=["img/0/0.1.0.0.0"])
+    with MinervaExporter("us-east-1", client_pool=FakePool(s3)) as exporter:
+        with pytest.raises(TransferFailed):
+            exporter.export_image_zarr(None, None, FakeMinervaClient(), "img", str(tmp_path))
+        assert len(s3.downloads) == 3
+
+        s3.fail.clear()
+        s3.downloads.clear()
+        exporter.export_image_zarr(None, None, FakeMinervaClient(), "img", str(tmp_path))
+        assert s3.downloads == ["img/0/0.1.0.0.0"]
+    # The worker threads are stopped when the exporter is closed
+    with pytest.raises(RuntimeError):
+        exporter.executor.submit(print)
+    with open(os.path.join(str(tmp_path), "img/0/0.1.0.0.0"), "rb") as f:
+        assert f.read() == b"chunk1"
+
+def test_export_zarr_records_every_download(tmp_path, monkeypatch):
+    add = TransferManifest.add
+
+    def slow_add(self, key, **attributes):
+        time.sleep(0.1)
+        add(self, key, **attributes)
+
+    # Downloads recorded late must still be in the manifest when the export returns
+    monkeypatch.setattr(TransferManifest, "add", slow_add)
+    with MinervaExporter("us-east-1", client_pool=FakePool(FakeS3(OBJECTS))) as exporter:
+        exporter.export_image_zarr(None, None, FakeMinervaClient(), "img", str(tmp_path))
+    with TransferManifest(str(tmp_path / MANIFEST_FILENAME)) as manifest:
+        assert sorted(manifest.entries) == sorted(OBJECTS)
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+def test_export_store(tmp_path):
+    s3 = FakeS3(OBJECTS)
+    s3.get_object = lambda Bucket, Key: {"Body": FakeBody(OBJECTS[Key])}
+    exporter = MinervaExporter("us-east-1", client_pool=FakePool(s3))
+    store = zarr.DirectoryStore(str(tmp_path))
+    progress = []
+    exporter.export_image_store(FakeMinervaClient(), "img", store, lambda a, b: progress.append(a), max_in_flight=2)
+    assert sorted(store.keys()) == [".zgroup", "0/.zarray", "0/0.0.0.0.0", "0/0.1.0.0.0"]
+    assert store["0/0.1.0.0.0"] == b"chunk1"
+    assert progress[-1] == 4
+
+
+class FakeArray:
+    def __init__(self, shape, chunks):
+        self.shape = shape
+        self.chunks = chunks
+
+
+class FakeSelectionClient(FakeMinervaClient):
+    def get_image_array(self, uuid, level=0):
+        return [FakeArray((1, 3, 1, 2048, 2048), (1, 1, 1, 512, 512)),
+                FakeArray((1, 3, 1, 1024, 1024), (1, 1, 1, 512, 512))][level]
+
+def test_export_zarr_selection(tmp_path):
+    objects = {"img/.zgroup": b"{}", "img/metadata.xml": b"<OME/>"}
+    for level, size in [(0, 4), (1, 2)]:
+        objects["img/%s/.zarray" % level] = b"{}"
+        for c in range(3):
+            for y in range(size):
+                for x in range(size):
+                    objects["img/%s/0.%s.0.%s.%s" % (level, c, y, x)] = b"chunk"
+
+    s3 = FakeS3(objects)
+    exporter = MinervaExporter("us-east-1", client_pool=FakePool(s3))
+    image = {"included": {"images": [{"pyramid_levels": 2}]}}
+    exporter.export_image_zarr(image, None, FakeSelectionClient(), "img", str(tmp_path),
+                               region=(600, 100, 500, 400), channels=[1], levels=[0])
+    assert sorted(s3.downloads) == ["img/.zgroup", "img/0/.zarray", "img/0/0.1.0.0.1", "img/0/0.1.0.0.2",
+                                    "img/metadata.xml"]
+    assert "img/0/0.1.0.0." in s3.listed and "img/0/0.1.0.1." not in s3.listed
+
+class CorruptingS3(FakeS3):
+    def paginate(self, Bucket, Prefix, PaginationConfig=None, Delimiter=None):
+        for page in FakeS3.paginate(self, Bucket, Prefix, PaginationConfig, Delimiter):
+            for obj in page["Contents"]:
+                obj["ETag"] = '"%s"' % hashlib.md5(self.objects[obj["Key"]]).hexdigest()
+            yield page
+
+    def download_file(self, Bucket, Key, Filename, Callback=None):
+        FakeS3.download_file(self, Bucket, Key, Filename, Callback)
+        if self.downloads.count(Key) == 1 and Key.endswith("0.0.0.0.0"):
+            with open(Filename, "wb") as f:
+                f.write(b"corrupted")
+
+def test_export_zarr_verify(tmp_path):
+    s3 = CorruptingS3(OBJECTS)
+    exporter = MinervaExporter("us-east-1", client_pool=FakePool(s3), verify="md5")
+    exporter.export_image_zarr(None, None, FakeMinervaClient(), "img", str(tmp_path))
+    summary = exporter.report.summary()
+    assert summary["verified"] == 4 and summary["retried"] == 1 and summary["failed"] == 0
+    with open(os.path.join(str(tmp_path), "img/0/0.0.0.0.0"), "rb") as f:
+        assert f.read() == b"chunk0"
@@ -0,0 +1,274 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import tifffile
+import zarr
+from minerva_lib import importing
+from minerva_lib.importing import MinervaImporter, plan_blocks, get_dimensions, default_checkpoint, \
+    CHECKPOINT_SUFFIX, encode_block
+from minerva_lib.util.integrity import TransferFailed, TransferReport
+from minerva_lib.util.s3 import S3Uploader
+
+
+def _write_pyramid(path, data, **options):
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(data, subifds=1, metadata={"axes": "CYX"}, **options)
+        tif.write(data[:, ::2, ::2], subfiletype=1, **options)
+
+def _import(tmp_path, monkeypatch, data, write_options=None, **kwargs):
+    # Dry run writes the image into ./zarrtmp instead of S3
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "image.ome.tif")
+    _write_pyramid(path, data, **(write_options or {"tile": (256, 256)}))
+    importer = MinervaImporter(None, S3Uploader("us-east-1"), dryrun=True)
+    importer.import_ome_tiff(path, "repository", **kwargs)
+    return importer, zarr.open(str(tmp_path / "zarrtmp"), mode="r")
+
+def test_import_ome_tiff(tmp_path, monkeypatch):
+    data = np.random.randint(0, 60000, (2, 1500, 1300)).astype(np.uint16)
+    importer, group = _import(tmp_path, monkeypatch, data)
+    assert group["0"].shape == (1, 2, 1, 1500, 1300)
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert np.array_equal(group["1"][0, :, 0], data[:, ::2, ::2])
+    assert importer.uploader.report.summary()["failed"] == 0
+
+def test_plan_blocks_tiles():
+    # 256 tiles are read in 1024 blocks, one destination chunk each
+    blocks = plan_blocks(1500, 1300, (1024, 1024), (256, 256))
+    assert blocks == [(0, 0, 1024, 1024), (0, 1024, 1024, 1024), (1024, 0, 1024, 1024), (1024, 1024, 1024, 1024)]
+
+def test_plan_blocks_strips():
+    # Strips span the full width, blocks are rounded up to whole chunk rows
+    blocks = plan_blocks(3000, 1300, (1024, 1024), (16, 1300))
+    assert blocks == [(0, 0, 1024, 2048), (1024, 0, 1024, 2048), (2048, 0, 1024, 2048)]
+
+def test_import_ome_tiff_strips(tmp_path, monkeypatch):
+    data = np.random.randint(0, 60000, (2, 1500, 1300)).astype(np.uint16)
+    importer, group = _import(tmp_path, monkeypatch, data, write_options={"rowsperstrip": 64})
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert np.array_equal(group["1"][0, :, 0], data[:, ::2, ::2])
+
+def test_import_ome_tiff_strip_chunks_in_parallel(tmp_path, monkeypatch):
+    data = np.random.randint(0, 60000, (1, 1500, 1300)).astype(np.uint16)
+    upload_zarr = MinervaImporter._upload_zarr
+    lock = threading.Lock()
+    active = [0, 0]
+
+    def slow_upload(self, arr, t, channel, z, y, x, tile):
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.05)
+        upload_zarr(self, arr, t, channel, z, y, x, tile)
+        with lock:
+            active[0] -= 1
+
+    monkeypatch.setattr(MinervaImporter, "_upload_zarr", slow_upload)
+    # One full-width strip block in flight at a time, its chunks are still written concurrently
+    importer, group = _import(tmp_path, monkeypatch, data, write_options={"rowsperstrip": 256},
+                              chunks=(1, 256, 256), max_in_flight_bytes=1)
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert active[1] > 1
+
+def test_import_ome_tiff_chunks_and_compression(tmp_path, monkeypatch):
+    data = np.random.randint(0, 60000, (3, 1500, 1300)).astype(np.uint16)
+    importer, group = _import(tmp_path, monkeypatch, data, chunks=(2, 512, 512), compression="lz4",
+                              compression_level=5, shuffle="bit")
+    assert group["0"].chunks == (1, 2, 1, 512, 512)
+    assert group["0"].compressor.cname == "lz4"
+    assert group["0"].compressor.shuffle == 2
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert np.array_equal(group["1"][0, :, 0], data[:, ::2, ::2])
+
+def test_trial_compression(tmp_path):
+    path = str(tmp_path / "image.ome.tif")
+    data = np.zeros((2, 1500, 1300), dtype=np.uint16)
+    data[:, ::3] = 1000
+    _write_pyramid(path, data, tile=(256, 256))
+    importer = MinervaImporter(None, S3Uploader("us-east-1"), dryrun=True)
+    results = importer.trial_compression(path, candidates=[("zstd", 3, "bit"), ("none", 0, "none")], tile_size=256)
+    assert [r["compression"] for r in results] == ["zstd", "none"]
+    assert results[0]["ratio"] > 10
+    assert results[1]["ratio"] == 1
+
+def test_import_ome_tiff_byte_budget(tmp_path, monkeypatch):
+    data = np.random.randint(0, 60000, (2, 1500, 1300)).astype(np.uint16)
+    budget = 3 * 512 * 512 * 2
+    importer, group = _import(tmp_path, monkeypatch, data, chunks=(1, 512, 512), max_in_flight_bytes=budget)
+    assert np.array_equal(group["0"][0, :, 0], data)
+    metrics = importer.metrics.summary()
+    assert 0 < metrics["peak_in_flight_bytes"] <= budget
+    assert metrics["queue_depth"] == 0 and metrics["in_flight_bytes"] == 0
+    assert metrics["completed_bytes"] == data.nbytes + data[:, ::2, ::2].nbytes
+
+def test_import_ome_tiff_skip_empty(tmp_path, monkeypatch):
+    data = np.zeros((2, 1500, 1300), dtype=np.uint16)
+    data[0, 100:200, 100:200] = 500
+    # Constant but not the fill value, must still be written
+    data[1, 1024:, 1024:] = 7
+    importer, group = _import(tmp_path, monkeypatch, data, skip_empty=True)
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert np.array_equal(group["1"][0, :, 0], data[:, ::2, ::2])
+    written = [key for key in os.listdir(str(tmp_path / "zarrtmp" / "0")) if not key.startswith(".")]
+    assert sorted(written) == ["0.0.0.0.0", "0.1.0.1.1"]
+    # Level 1 is a single chunk per channel, both hold data
+    assert importer.metrics.summary()["skipped"] == 6
+
+def test_import_ome_tiff_resume(tmp_path, monkeypatch):
+    data = np.random.randint(0, 60000, (2, 1500, 1300)).astype(np.uint16)
+    upload_zarr = MinervaImporter._upload_zarr
+
+    def fail_bottom(self, arr, t, channel, z, y, x, tile):
+        if arr.name == "/0" and y >= 1024:
+            raise IOError("Connection reset")
+        upload_zarr(self, arr, t, channel, z, y, x, tile)
+
+    monkeypatch.setattr(MinervaImporter, "_upload_zarr", fail_bottom)
+    with pytest.raises(TransferFailed):
+        _import(tmp_path, monkeypatch, data)
+    checkpoint = tmp_path / default_checkpoint(str(tmp_path / "image.ome.tif"))
+    assert checkpoint.exists()
+
+    uploaded = []
+    def count(self, arr, t, channel, z, y, x, tile):
+        uploaded.append((arr.name, channel, y, x))
+        upload_zarr(self, arr, t, channel, z, y, x, tile)
+
+    monkeypatch.setattr(MinervaImporter, "_upload_zarr", count)
+    importer, group = _import(tmp_path, monkeypatch, data, resume=True)
+    # Only the failed bottom row of level 0 is imported again
+    assert sorted(uploaded) == [("/0", c, 1024, x) for c in (0, 1) for x in (0, 1024)]
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert np.array_equal(group["1"][0, :, 0], data[:, ::2, ::2])
+    assert not checkpoint.exists()
+
+def test_import_ome_tiff_new_report(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = np.random.randint(0, 60000, (2, 1500, 1300)).astype(np.uint16)
+    path = str(tmp_path / "image.ome.tif")
+    _write_pyramid(path, data, tile=(256, 256))
+    importer = MinervaImporter(None, S3Uploader("us-east-1"), dryrun=True)
+    upload_zarr = MinervaImporter._upload_zarr
+
+    def fail(self, arr, t, channel, z, y, x, tile):
+        raise IOError("Connection reset")
+
+    monkeypatch.setattr(MinervaImporter, "_upload_zarr", fail)
+    with pytest.raises(TransferFailed):
+        importer.import_ome_tiff(path, "repository")
+    # Failures of the previous import are not reported again
+    monkeypatch.setattr(MinervaImporter, "_upload_zarr", upload_zarr)
+    importer.import_ome_tiff(path, "repository", resume=True)
+    assert importer.uploader.report.summary()["failed"] == 0
+
+def test_record_block_failure_with_verification():
+    # A block which fails while reading never reaches the VerifiedStore, so it is reported by the importer
+    job = SimpleNamespace(verify=True, failures=0, completed=set())
+    future = Future()
+    future.set_exception(IOError("Cannot read tile"))
+    report = TransferReport()
+    MinervaImporter._record_block(report, job, "0/0/0/0/0", "image/0/0.0", future)
+    assert job.failures == 1 and not job.completed
+    assert report.failed == {"image/0/0.0": "Cannot read tile"}
+    with pytest.raises(TransferFailed):
+        report.raise_for_failures()
+
+def test_import_ome_tiffs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    images = {}
+    for i in range(3):
+        path = str(tmp_path / "image{}.ome.tif".format(i))
+        images[path] = np.random.randint(0, 60000, (2, 1500, 1300)).astype(np.uint16)
+        _write_pyramid(path, images[path], tile=(256, 256))
+
+    progress = []
+    importer = MinervaImporter(None, S3Uploader("us-east-1"), dryrun=True)
+    uuids = importer.import_ome_tiffs([str(tmp_path / "image*.ome.tif")], "repository", max_workers=4,
+                                      interleave=2, progress_callback=lambda a, b: progress.append((a, b)))
+    assert sorted(uuids) == sorted(images)
+    for path, data in images.items():
+        group = zarr.open(str(tmp_path / "zarrtmp" / str(uuids[path])), mode="r")
+        assert np.array_equal(group["0"][0, :, 0], data)
+        assert np.array_equal(group["1"][0, :, 0], data[:, ::2, ::2])
+    assert progress[-1] == (3 * 10, 3 * 10)
+    assert importer.metrics.summary()["completed_bytes"] == 3 * (images[path].nbytes + data[:, ::2, ::2].nbytes)
+    assert not list(tmp_path.glob("*" + CHECKPOINT_SUFFIX))
+
+def test_import_ome_tiffs_unreadable_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = np.random.randint(0, 60000, (2, 1500, 1300)).astype(np.uint16)
+    _write_pyramid(str(tmp_path / "image0.ome.tif"), data, tile=(256, 256))
+    (tmp_path / "image1.ome.tif").write_bytes(b"not a tiff")
+
+    importer = MinervaImporter(None, S3Uploader("us-east-1"), dryrun=True)
+    with pytest.raises(TransferFailed) as e:
+        importer.import_ome_tiffs([str(tmp_path / "image*.ome.tif")], "repository", max_workers=4)
+    assert list(e.value.report.failed) == [str(tmp_path / "image1.ome.tif")]
+    # The readable file is still imported completely
+    uuid = os.listdir(str(tmp_path / "zarrtmp"))[0]
+    group = zarr.open(str(tmp_path / "zarrtmp" / uuid), mode="r")
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert not list(tmp_path.glob("*" + CHECKPOINT_SUFFIX))
+
+def test_import_ome_tiff_processes(tmp_path, monkeypatch):
+    data = np.zeros((3, 1500, 1300), dtype=np.uint16)
+    data[:, :1000] = np.random.randint(0, 60000, (3, 1000, 1300))
+    importer, group = _import(tmp_path, monkeypatch, data, processes=2, chunks=(2, 512, 512), skip_empty=True,
+                              blosc_threads=2)
+    assert np.array_equal(group["0"][0, :, 0], data)
+    assert np.array_equal(group["1"][0, :, 0], data[:, ::2, ::2])
+    # Bottom chunk row of both levels, for both channel groups
+    assert importer.metrics.summary()["skipped"] == 2 * 3 + 2 * 2
+
+def test_import_ome_tiff_blosc_threads_without_processes(tmp_path, monkeypatch):
+    data = np.random.randint(0, 60000, (2, 600, 500)).astype(np.uint16)
+    with pytest.raises(ValueError):
+        _import(tmp_path, monkeypatch, data, blosc_threads=2)
+
+def test_encode_block_closes_old_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(importing, "_process_readers", importing.collections.OrderedDict())
+    monkeypatch.setattr(importing, "MAX_PROCESS_READERS", 1)
+    data = np.random.randint(0, 60000, (2, 600, 500)).astype(np.uint16)
+    paths = [str(tmp_path / "image{}.ome.tif".format(i)) for i in range(2)]
+    for path in paths:
+        _write_pyramid(path, data, tile=(256, 256))
+
+    encoded, nbytes = encode_block(paths[0], 0, 0, 0, 0, 0, 0, 256, 256, (2, 256, 256), data.dtype, None, 0)
+    assert nbytes == 2 * 256 * 256 * 2
+    first = importing._process_readers[paths[0]]
+    assert first._handles
+    encode_block(paths[1], 0, 0, 0, 0, 0, 0, 256, 256, (2, 256, 256), data.dtype, None, 0)
+    assert list(importing._process_readers) == [paths[1]]
+    assert not first._handles
+    importing._process_readers[paths[1]].close()
+
+def test_get_dimensions():
+    assert get_dimensions((3, 4, 600, 500), "ZCYX") == (1, 4, 3, 600, 500)
+    assert get_dimensions((600, 500, 3), "YXS") == (1, 3, 1, 600, 500)
+    assert get_dimensions((600, 500), "YX") == (1, 1, 1, 600, 500)
+    with pytest.raises(ValueError):
+        get_dimensions((2, 3, 600, 500), "RCYX")
+
+def test_import_ome_tiff_time_and_z(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "image.ome.tif")
+    data = np.random.randint(0, 60000, (2, 3, 4, 1100, 700)).astype(np.uint16)
+    with tifffile.TiffWriter(path, bigtiff=True, ome=True) as tif:
+        tif.write(data, subifds=1, metadata={"axes": "TCZYX"}, tile=(256, 256))
+        tif.write(data[..., ::2, ::2], subfiletype=1, tile=(256, 256))
+
+    importer = MinervaImporter(None, S3Uploader("us-east-1"), dryrun=True)
+    importer.import_ome_tiff(path, "repository")
+    group = zarr.open(str(tmp_path / "zarrtmp"), mode="r")
+    assert group["0"].shape == (2, 3, 4, 1100, 700)
+    assert np.array_equal(group["0"][:], data)
+    assert np.array_equal(group["1"][:], data[..., ::2, ::2])
+
+def test_default_checkpoint_per_path():
+    first, second = default_checkpoint("a/img.ome.tif"), default_checkpoint("b/img.ome.tif")
+    assert first != second
+    assert first.startswith("img.ome.tif.") and first.endswith(CHECKPOINT_SUFFIX)
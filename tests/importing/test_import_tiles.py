@@ -0,0 +1,100 @@
+import struct
+import time
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+from minerva_lib.importing import MinervaImporter
+from minerva_lib.util.integrity import TransferReport, TransferFailed
+from minerva_lib.util.s3 import S3Uploader
+
+
+def _write_png_header(path, depth=16, color=0):
+    ihdr = struct.pack(">IIBBBBB", 256, 256, depth, color, 0, 0, 0)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + b"IHDR" + ihdr + b"\0\0\0\0")
+
+
+class FakeFuture:
+    # Completes when the importer waits for it, so the number of pending uploads can be observed
+    def __init__(self):
+        self.completed = False
+
+    def result(self):
+        self.completed = True
+
+
+class FakeUploader:
+    def __init__(self):
+        self.report = TransferReport()
+        self.uploaded = []
+        self.max_pending = 0
+        self.pending = []
+
+    def reset_report(self):
+        self.report = TransferReport()
+        return self.report
+
+    def upload_file_async(self, filepath, bucket, object_name, credentials, callback=None):
+        self.pending = [f for f in self.pending if not f.completed]
+        future = FakeFuture()
+        self.pending.append(future)
+        self.max_pending = max(self.max_pending, len(self.pending))
+        self.uploaded.append(object_name)
+        self.report.add_success(object_name, 1)
+        return future
+
+
+def test_import_tile_directory(tmp_path):
+    for i in range(50):
+        _write_png_header(str(tmp_path / "C0-T0-Z0-L0-Y{}-X{}.png".format(i // 10, i % 10)))
+    (tmp_path / "notes.txt").write_text("not a tile")
+
+    progress = []
+    importer = MinervaImporter(None, FakeUploader(), dryrun=True)
+    count = importer.import_tile_directory(str(tmp_path), "image", max_in_flight=8,
+                                           progress_callback=lambda a, b: progress.append((a, b)), max_workers=4)
+    assert count == 50
+    assert sorted(importer.uploader.uploaded) == sorted("prefix/C0-T0-Z0-L0-Y{}-X{}.png".format(i // 10, i % 10)
+                                                        for i in range(50))
+    assert importer.uploader.max_pending <= 8
+    assert progress[-1] == (50, 50)
+
+
+def test_import_tile_directory_invalid(tmp_path):
+    _write_png_header(str(tmp_path / "C0-T0-Z0-L0-Y0-X0.png"))
+    _write_png_header(str(tmp_path / "C0-T0-Z0-L0-Y0-X1.png"), depth=8)
+    importer = MinervaImporter(None, FakeUploader(), dryrun=True)
+    with pytest.raises(ValueError):
+        importer.import_tile_directory(str(tmp_path), "image")
+    assert importer.uploader.uploaded == []
+
+
+class StubbedPool:
+    max_clients = 16
+
+    def __init__(self):
+        self.client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="key",
+                                   aws_secret_access_key="secret")
+        self.stubber = Stubber(self.client)
+
+    def get(self, credentials):
+        return self.client
+
+
+def test_import_tile_directory_failed_upload(tmp_path, monkeypatch):
+    _write_png_header(str(tmp_path / "C0-T0-Z0-L0-Y0-X0.png"))
+    add_failure = TransferReport.add_failure
+
+    def slow_add_failure(self, key, error):
+        time.sleep(0.3)
+        add_failure(self, key, error)
+
+    # The failure is recorded late, it must still be seen before the import returns
+    monkeypatch.setattr(TransferReport, "add_failure", slow_add_failure)
+    pool = StubbedPool()
+    pool.stubber.add_client_error("put_object", "AccessDenied", http_status_code=403)
+    importer = MinervaImporter(None, S3Uploader("us-east-1", client_pool=pool), dryrun=True)
+    with pool.stubber, pytest.raises(TransferFailed):
+        importer.import_tile_directory(str(tmp_path), "image", validate=False)
+    importer.uploader.wait_upload()
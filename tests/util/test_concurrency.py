@@ -0,0 +1,50 @@
+import threading
+import time
+
+import botocore.exceptions
+import pytest
+from minerva_lib.util.concurrency import AdaptiveConcurrency
+
+
+def _slow_down():
+    return botocore.exceptions.ClientError({"Error": {"Code": "SlowDown"}}, "PutObject")
+
+def test_increase_and_decrease():
+    concurrency = AdaptiveConcurrency(initial=4, minimum=2, maximum=8, min_interval=0)
+    for _ in range(4):
+        concurrency.acquire()
+    for _ in range(4):
+        concurrency.release()
+    assert concurrency.limit == 5
+
+    for _ in range(4):
+        concurrency.acquire()
+        concurrency.release()
+    concurrency.acquire()
+    concurrency.release(_slow_down())
+    assert concurrency.limit == 2
+    assert concurrency.summary()["throttled"] == 1
+
+def test_limits():
+    with pytest.raises(ValueError):
+        AdaptiveConcurrency(initial=1, minimum=2)
+    concurrency = AdaptiveConcurrency.fixed(3)
+    assert (concurrency.minimum, concurrency.limit, concurrency.maximum) == (3, 3, 3)
+
+def test_call_limits_active_transfers():
+    concurrency = AdaptiveConcurrency.fixed(3)
+    active = []
+    lock = threading.Lock()
+
+    def transfer():
+        with lock:
+            active.append(concurrency.active)
+        time.sleep(0.01)
+
+    threads = [threading.Thread(target=concurrency.call, args=(transfer,)) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(active) == 3
+    assert concurrency.summary()["completed"] == 12
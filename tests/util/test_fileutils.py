@@ -8,4 +8,12 @@ def test_pyramid_levels():
         "C0-T0-Z0-L1-Y0-X0.png"
     ]
     pyramid_levels = FileUtils.get_pyramid_levels(files)
-    assert(pyramid_levels == 3)
\ No newline at end of file
+    assert(pyramid_levels == 3)
+
+
+def test_scan_files_regex(tmp_path):
+    for name in ["C0-T0-Z0-L0-Y0-X1.png", "C0-T0-Z0-L0-Y0-X0.png", "readme.txt"]:
+        (tmp_path / name).write_bytes(b"")
+    (tmp_path / "C0-T0-Z0-L0-Y1-X0.png").mkdir()
+    files = FileUtils.scan_files_regex(str(tmp_path), FileUtils._file_pattern)
+    assert files == [str(tmp_path / "C0-T0-Z0-L0-Y0-X0.png"), str(tmp_path / "C0-T0-Z0-L0-Y0-X1.png")]
@@ -0,0 +1,36 @@
+import hashlib
+import pytest
+from minerva_lib.util.integrity import md5_etag, etag_matches, TransferReport, TransferFailed
+
+MIB = 1024 * 1024
+
+def test_md5_etag(tmp_path):
+    data = b"x" * (2 * MIB + 10)
+    path = str(tmp_path / "data")
+    with open(path, "wb") as f:
+        f.write(data)
+
+    assert md5_etag(data) == hashlib.md5(data).hexdigest()
+    assert md5_etag(path) == hashlib.md5(data).hexdigest()
+    parts = [hashlib.md5(data[i:i + MIB]).digest() for i in range(0, len(data), MIB)]
+    assert md5_etag(path, MIB) == hashlib.md5(b"".join(parts)).hexdigest() + "-3"
+
+def test_etag_matches():
+    data = b"y" * (3 * MIB)
+    assert etag_matches('"%s"' % hashlib.md5(data).hexdigest(), data)
+    assert not etag_matches('"%s"' % hashlib.md5(b"other").hexdigest(), data)
+    assert etag_matches(md5_etag(data, MIB), data, part_size=8 * MIB)
+    assert etag_matches("abc", data) is None
+    # Same part count, different content
+    assert etag_matches(md5_etag(b"z" * (3 * MIB), MIB), data, part_size=MIB) is False
+    # No MiB aligned part size splits 3 MiB into 7 parts
+    assert etag_matches(md5_etag(data, MIB // 2)[:-2] + "-7", data) is None
+
+def test_report():
+    report = TransferReport()
+    report.add_retry("a", "mismatch")
+    report.add_success("a", 10, verified=True)
+    report.add_failure("b", IOError("timeout"))
+    assert report.summary() == {"transferred": 1, "bytes": 10, "verified": 1, "unverified": 0, "retried": 1, "failed": 1}
+    with pytest.raises(TransferFailed):
+        report.raise_for_failures()
@@ -0,0 +1,19 @@
+from minerva_lib.util.manifest import TransferManifest
+
+def test_manifest_resume(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    with TransferManifest(path) as manifest:
+        manifest.add("image/0/0.0.0.0.0", size=10, etag='"abc"')
+
+    with open(path, "a") as f:
+        f.write('{"key": "partial')
+
+    manifest = TransferManifest(path)
+    assert manifest.is_complete("image/0/0.0.0.0.0", 10, '"abc"')
+    assert not manifest.is_complete("image/0/0.0.0.0.0", 10, '"changed"')
+    assert not manifest.is_complete("image/0/0.0.0.0.1")
+    # Entries added after the partial line are read back when resuming again
+    manifest.add("image/0/0.0.0.0.1", size=12)
+    manifest.close()
+    with TransferManifest(path) as manifest:
+        assert manifest.is_complete("image/0/0.0.0.0.1", 12)
@@ -0,0 +1,41 @@
+import threading
+import time
+
+import pytest
+from minerva_lib.util import ratelimit
+from minerva_lib.util.ratelimit import TokenBucket, RateLimitedStore
+
+
+@pytest.fixture
+def limits():
+    yield ratelimit.set_bandwidth_limit
+    ratelimit.set_bandwidth_limit()
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(1e6, burst=1e5)
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.consume(1e5)
+    # The burst is free, the remaining 200 kB take 0.2 s
+    assert 0.18 <= time.monotonic() - start < 1
+
+def test_token_bucket_shared_by_threads():
+    bucket = TokenBucket(2e6, burst=1e5)
+    threads = [threading.Thread(target=bucket.consume, args=(1e5,)) for _ in range(9)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 0.38 <= time.monotonic() - start < 1.5
+
+def test_rate_limited_store(limits):
+    limits(upload=1, download=None, burst_seconds=0.1)
+    store = RateLimitedStore({})
+    start = time.monotonic()
+    for i in range(3):
+        store[str(i)] = b"x" * 100000
+    assert time.monotonic() - start >= 0.18
+    assert ratelimit.get_limiter("download") is None
+    assert store["0"] == b"x" * 100000
+    assert len(store) == 3
@@ -0,0 +1,150 @@
+import io
+import time
+
+import boto3
+import botocore.exceptions
+import pytest
+from botocore.stub import Stubber
+from minerva_lib.util import s3 as s3_module
+from minerva_lib.util.concurrency import AdaptiveConcurrency
+from minerva_lib.util.integrity import ChecksumMismatch
+from minerva_lib.util.s3 import S3ClientPool, S3Destination, S3Uploader
+
+def _credentials(key_id):
+    return {"AccessKeyId": key_id, "SecretAccessKey": "secret", "SessionToken": "token"}
+
+def test_client_pool_reuses_clients():
+    pool = S3ClientPool("us-east-1", max_pool_connections=32)
+    client = pool.get(_credentials("A"))
+    assert pool.get(_credentials("A")) is client
+    assert pool.get(_credentials("B")) is not client
+    assert client.meta.config.max_pool_connections == 32
+
+def test_client_pool_evicts_least_recently_used():
+    pool = S3ClientPool("us-east-1", max_clients=2)
+    a = pool.get(_credentials("A"))
+    pool.get(_credentials("B"))
+    pool.get(_credentials("A"))
+    pool.get(_credentials("C"))
+    assert pool.get(_credentials("A")) is a
+    assert len(pool._clients) == 2
+
+def test_uploader_evicts_transfer_managers():
+    uploader = S3Uploader("us-east-1", client_pool=S3ClientPool("us-east-1", max_clients=2))
+
+    def get(key_id):
+        manager = uploader._get_transfer_manager(_credentials(key_id))
+        uploader._release_transfer_manager(manager)
+        return manager
+
+    a = get("A")
+    b = get("B")
+    get("A")
+    get("C")
+    assert len(uploader._transfer_managers) == 2
+    assert get("A") is a
+    assert get("B") is not b
+    assert not uploader._retired_managers
+    uploader.wait_upload()
+
+def test_uploader_keeps_evicted_manager_in_use():
+    pool = StubbedPool()
+    pool.max_clients = 1
+    pool.stubber.add_response("put_object", {"ETag": '"etag"'})
+    uploader = S3Uploader("us-east-1", client_pool=pool)
+    # Another thread received the manager just before it is evicted
+    a = uploader._get_transfer_manager(_credentials("A"))
+    uploader._release_transfer_manager(uploader._get_transfer_manager(_credentials("B")))
+    assert uploader._retired_managers == [a]
+    with pool.stubber:
+        a.upload(io.BytesIO(b"data"), "bucket", "key").result()
+    uploader._release_transfer_manager(a)
+    uploader._release_transfer_manager(uploader._get_transfer_manager(_credentials("B")))
+    assert not uploader._retired_managers
+    uploader.wait_upload()
+
+class FakeDestinationClient:
+    def __init__(self, deny_copy):
+        self.deny_copy = deny_copy
+        self.copied = []
+        self.uploaded = []
+
+    def copy_object(self, CopySource, Bucket, Key):
+        if self.deny_copy:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "CopyObject")
+        self.copied.append((CopySource["Key"], Key))
+
+    def upload_fileobj(self, body, bucket, key, Callback=None):
+        self.uploaded.append((body, key))
+
+
+class FakeSourceClient:
+    def get_object(self, Bucket, Key):
+        return {"Body": Key}
+
+
+class FixedPool:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, credentials):
+        return self.client
+
+def test_destination_server_side_copy():
+    client = FakeDestinationClient(deny_copy=False)
+    destination = S3Destination("bucket", "/copy/", _credentials("A"), client_pool=FixedPool(client))
+    destination.copy(FakeSourceClient(), "source", "img/0/0.0.0.0.0", "0/0.0.0.0.0")
+    assert client.copied == [("img/0/0.0.0.0.0", "copy/0/0.0.0.0.0")]
+
+def test_destination_falls_back_to_streaming():
+    client = FakeDestinationClient(deny_copy=True)
+    destination = S3Destination("bucket", "", _credentials("A"), client_pool=FixedPool(client))
+    destination.copy(FakeSourceClient(), "source", "img/.zgroup", ".zgroup")
+    destination.copy(FakeSourceClient(), "source", "img/0/.zarray", "0/.zarray")
+    assert client.uploaded == [("img/.zgroup", ".zgroup"), ("img/0/.zarray", "0/.zarray")]
+
+class StubbedPool:
+    max_clients = 16
+
+    def __init__(self):
+        self.client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="key",
+                                   aws_secret_access_key="secret")
+        self.stubber = Stubber(self.client)
+
+    def get(self, credentials):
+        return self.client
+
+def test_upload_recorded_before_result(monkeypatch):
+    def slow_mismatch(*args, **kwargs):
+        time.sleep(0.5)
+        return False
+
+    monkeypatch.setattr(s3_module, "verify_object", slow_mismatch)
+    pool = StubbedPool()
+    pool.stubber.add_response("put_object", {"ETag": '"etag"'})
+    uploader = S3Uploader("us-east-1", client_pool=pool, verify="md5")
+    with pool.stubber:
+        future = uploader.upload_data_async(b"data", "bucket", "key", _credentials("A"))
+        # The verification result is known once the caller stops waiting
+        with pytest.raises(ChecksumMismatch):
+            future.result()
+        assert uploader.report.summary()["failed"] == 1
+        uploader.wait_upload()
+
+def test_upload_releases_concurrency_before_result(monkeypatch):
+    release = AdaptiveConcurrency.release
+
+    def slow_release(self, error=None):
+        time.sleep(0.3)
+        release(self, error)
+
+    monkeypatch.setattr(AdaptiveConcurrency, "release", slow_release)
+    pool = StubbedPool()
+    pool.stubber.add_response("put_object", {"ETag": '"etag"'})
+    concurrency = AdaptiveConcurrency(2, 1, 4)
+    uploader = S3Uploader("us-east-1", client_pool=pool, concurrency=concurrency)
+    with pool.stubber:
+        uploader.upload_data_async(b"data", "bucket", "key", _credentials("A")).result()
+        assert concurrency.active == 0
+        assert uploader.report.summary()["transferred"] == 1
+        uploader.wait_upload()